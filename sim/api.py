@@ -1,5 +1,5 @@
 import core
-from random import random as rand
+import itertools
 
 # There is one instance of this: NullAddress
 # It can be used for non-routable packets and such.  It has the
@@ -23,6 +23,9 @@ def create_timer (seconds, target, recurring = True, pass_self = False,
     Will also pass itself as a final positional argument if pass_self
     is True.
     You can call .cancel() on the returned timer object to cancel it.
+    Timers fire on a 10ms tick (see sim/wheel.py), so a timer can fire up
+    to 10ms after it's due, and timers due in the same tick fire together
+    (in the order they were set).
     """
     if recurring:
         return core.Timer(seconds, target=target,
@@ -52,7 +55,49 @@ def hsv_to_rgb (h, s, v, a = 1):
   return [r,g,b,a]
 
 
+# Packets take their outer colors from this palette, in turn, the first time
+# anyone (i.e., the GUI) looks at them
+def _palette (n = 256):
+  import random
+  r = random.Random(168)
+  # Just red, green and blue: the alpha depends on the kind of packet
+  return [tuple(hsv_to_rgb(r.random(), r.random()*.25+.1,
+                           r.random()*.95+.5)[:3])
+          for _ in range(n)]
+
+_PALETTE = _palette()
+_hues = itertools.count()
+
+_slots = {} # class -> [(name, member descriptor)] for all its slots
+
+# What send() gives each envelope of its own (see Packet._envelope())
+_ENVELOPE = frozenset(('_body', '_shared', 'ttl', '_trail', '_clean'))
+
+def _slots_of (cls):
+  """ Returns [(name, descriptor)] for the slots of a class and its bases """
+  r = _slots.get(cls)
+  if r is None:
+    r = []
+    for c in reversed(cls.__mro__):
+      names = c.__dict__.get('__slots__', ())
+      if isinstance(names, str): names = (names,)
+      r.extend((n, c.__dict__[n]) for n in names
+               if n not in ('__dict__', '__weakref__'))
+    _slots[cls] = r
+  return r
+
+
 class Packet (object):
+  # Packets are small, so they use slots for what every packet has.  They
+  # still have a __dict__ (made when it's first needed), so you can give
+  # your packets any other attributes you like.
+  __slots__ = ('src', 'dst', 'ttl', '_trail', '_body', '_shared', '_clean',
+               '_hue', '_outer', '_inner', '__dict__')
+
+  _ALPHA = .75 # Of the outer color
+  _INNER = (0,0,0,0) # Inner color (transparent)
+  _SIZE = 64 # Bytes (see wire_size())
+
   def __init__ (self, dst=NullAddress, src=NullAddress):
     """
     Create a packet from src to dst.
@@ -60,23 +105,159 @@ class Packet (object):
     If dst is None, nothing special happens, but when it gets
     to the next hop, the receiver probably won't know what to do with it!
     """
-    self.src = src
-    self.dst = dst
-    self.ttl = 20   # TTL.  Decremented for each entity we go through.
-    self.trace = [] # Trace of all entities we've been sent through.
-
+    # (Set without going through __setattr__, which a new packet doesn't
+    # need, since it's called a lot)
+    s = object.__setattr__
+    s(self, 'src', src)
+    s(self, 'dst', dst)
+    s(self, 'ttl', 20)   # TTL.  Decremented for each entity we go through.
+    s(self, '_trail', None) # Where it's been (see trace)
+    s(self, '_body', None) # See _envelope()
+    s(self, '_shared', False)
+    s(self, '_clean', False)
     # When using NetVis, packets are visible, and you can set the color.
-    # color is a list of red, green, blue, and (optionally) alpha values.
-    # Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
-    self.outer_color = hsv_to_rgb(rand(), rand()*.25+.1, rand()*.95+.5,.75)
-    self.inner_color = [0,0,0,0] # transparent
+    # See outer_color and inner_color.
+    s(self, '_hue', next(_hues))
+    s(self, '_outer', None)
+    s(self, '_inner', None)
+
+  @property
+  def trace (self):
+    """
+    A list of all the entities the packet's been sent through.
+    Copies of a packet sent out of different ports share the part of their
+    trace from before that, as (entity, rest) pairs; this is a fresh list
+    every time.
+    """
+    r = []
+    t = self._trail
+    while t is not None:
+      r.append(t[0])
+      t = t[1]
+    r.reverse()
+    return r
+
+  @trace.setter
+  def trace (self, entities):
+    t = None
+    for e in entities:
+      t = (e, t)
+    self._trail = t
+
+  @property
+  def outer_color (self):
+    """
+    A list of red, green, blue, and (optionally) alpha values.
+    Each value is between 0 and 1.  alpha of 0 is transparent.  1 is opaque.
+    """
+    c = self._outer
+    if c is None:
+      c = list(_PALETTE[self._hue % len(_PALETTE)])
+      c.append(self._ALPHA)
+      # Not through __setattr__: a color that's only been looked at (say,
+      # by the GUI) isn't something the packet has of its own
+      object.__setattr__(self, '_outer', c)
+    return c
+
+  @outer_color.setter
+  def outer_color (self, color):
+    self._outer = color
+
+  @property
+  def inner_color (self):
+    """ Like outer_color """
+    c = self._inner
+    if c is None:
+      c = list(self._INNER)
+      object.__setattr__(self, '_inner', c) # As in outer_color
+    return c
+
+  @inner_color.setter
+  def inner_color (self, color):
+    self._inner = color
 
   def mark (self, entity):
     """
     You should never call this.  It's called by the framework to track
     where a packet has been, so that you can inspect it in self.trace.
     """
-    self.trace.append(entity)
+    object.__setattr__(self, '_trail', (entity, self._trail))
+
+  # When a packet is sent, each port gets an envelope: a packet of the same
+  # class with a ttl and trace of its own, which reads everything else from
+  # a body shared by all of them.  So packets aren't copied for each port,
+  # and setting an attribute on one only changes that one.  But don't
+  # change the insides of a packet that's been sent or received (like the
+  # lists and dicts in it); make a new one instead.
+
+  def __setattr__ (self, name, value):
+    object.__setattr__(self, name, value)
+    if name not in _ENVELOPE:
+      # It's no longer just an envelope (see _envelope())
+      object.__setattr__(self, '_clean', False)
+
+  def __getattr__ (self, name):
+    # Only called for attributes the packet doesn't have itself
+    try:
+      body = object.__getattribute__(self, '_body')
+    except AttributeError:
+      raise AttributeError(name)
+    if body is None:
+      raise AttributeError(name)
+    return getattr(body, name)
+
+  def _state (self):
+    """ Returns [(name, value)] for the attributes the packet has itself """
+    r = []
+    for name, slot in _slots_of(type(self)):
+      try:
+        r.append((name, slot.__get__(self)))
+      except AttributeError:
+        pass
+    d = getattr(self, '__dict__', None)
+    if d: r.extend(d.iteritems())
+    return r
+
+  def __getstate__ (self):
+    # As tuples, which sim/spill.py can pickle along with the packet
+    # (unlike the dict of slots pickle would make otherwise)
+    return tuple(self._state())
+
+  def __setstate__ (self, state):
+    for name, value in state:
+      object.__setattr__(self, name, value)
+
+  def _envelope (self):
+    """
+    Returns (body, [(name, value)]): the body that the envelopes send()
+    makes for this packet share, and what else they start out with (apart
+    from their ttl and trace).
+    """
+    if self._body is not None:
+      # The new envelopes share it with this one (which sim/spill.py needs
+      # to know)
+      object.__setattr__(self._body, '_shared', True)
+      # An envelope that has nothing of its own but its ttl and trace --
+      # which is what's usually forwarded -- doesn't need looking through
+      if self._clean:
+        return (self._body, ())
+      return (self._body, [(n, v) for n, v in self._state()
+                           if n not in _ENVELOPE])
+    # A new packet: its body is a copy of it as it is now, so changing it
+    # afterwards doesn't change the packets already sent
+    body = object.__new__(type(self))
+    for n, v in self._state():
+      setattr(body, n, v)
+    body._shared = True
+    self._shared = True
+    return (body, ())
+
+  def wire_size (self):
+    """
+    How many bytes the packet takes up on cables that have a bandwidth
+    (see cable.BandwidthCable).  Override it for packets that carry more.
+    """
+    return self._SIZE
 
   def __repr__ (self):
     return "<%s from %s->%s>" % (self.__class__.__name__,
@@ -87,7 +268,14 @@ class Packet (object):
 class Entity (object):
   """
   Base class for all entities (switches, hosts, etc.).
+  If you need random numbers, use self.random (a random.Random) rather
+  than the random module, so that runs with the same seed are the same.
+  It's there once the entity has been created (but not in __init__),
+  unless the entity already has a random attribute of its own.
   """
+  # The TopoNode that connects the entity to the simulator, which the
+  # methods below use.  Set when it's created (so not yet in __init__).
+  _node = None
 
   @classmethod
   def create (cls, name, *args, **kw):
@@ -100,10 +288,9 @@ class Entity (object):
   def get_port_count (self):
     """
     Returns the number of ports this entity has.
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._node is None: return None
+    return len(self._node.ports)
 
   def handle_rx (self, packet, port):
     """
@@ -114,13 +301,26 @@ class Entity (object):
     """
     pass
 
+  def handle_rx_batch (self, packets):
+    """
+    Called by the framework with a list of (packet, port) pairs: all the
+    packets that arrived at this Entity at the same time.
+    By default, it just calls handle_rx() for each of them, and in fact,
+    unless you override it, the framework calls handle_rx() directly.
+    If you do override it, you can, e.g., update your routing table with
+    all of them and then tell your neighbors about it once.
+    """
+    for packet, port in packets:
+      self.handle_rx(packet, port)
+
   def set_debug (self, *args):
     """
     Turns all arguments into a debug message for this Entity.
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._node is None: return
+    sim = self._node.sim
+    sim.world.do(sim.events.set_debug, self.name,
+                 ' '.join((str(s) for s in args)))
 
   def log (self, msg, *args, **kwargs):
     """
@@ -135,11 +335,15 @@ class Entity (object):
     See the main simulator.py for some more info about configuring the
     logs.
     Note that you can also use api.userlog.debug(...) and friends directly.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._node is None: return
+    level = kwargs.pop("level", "debug").lower()
+    if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
+      level = "debug"
+    func = getattr(userlog, level)
+    msg = "%s:" + msg # Black magic
+    args = (self.name,) + args
+    func(msg, *args, **kwargs)
 
   def send (self, packet, port=None, flood=False):
     """
@@ -149,20 +353,28 @@ class Entity (object):
     port can be a numeric port number, or a list of port numbers.
     If flood is True, the meaning of port is reversed -- packets will
     be sent from all ports EXCEPT those listed.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._node is None: return
+    self._node.send(packet, port, flood)
 
   def remove (self):
     """
     Removes this entity from existence.
-
-    This function may appear to be unimplemented, but it does
-    in fact work.
     """
-    pass
+    if self._node is None: return
+    self._node.sim.remove_entity(self)
+
+  def linkTo (self, other, cable = None, fillEmpty = True, latency = None):
+    """ Connects this entity to another (see core.TopoNode.linkTo()) """
+    return self._node.linkTo(other, cable, fillEmpty, latency)
+
+  def unlinkTo (self, other):
+    """ Disconnects this entity from another """
+    return self._node.unlinkTo(other)
+
+  def disconnect (self):
+    """ Disconnects this entity from everything """
+    return self._node.disconnect()
 
   def __repr__ (self):
     return "<" + self.__class__.__name__ + " " + str(self.name) + ">"
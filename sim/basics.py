@@ -7,6 +7,29 @@ class BasicHost (HostEntity):
     """ Sends a Ping packet to dst. """
     self.send(Ping(dst, data=data), flood=True)
 
+  def ping_and_wait (self, dst, data=None, timeout=None):
+    """
+    Sends a Ping packet to dst, and returns a Future that happens when the
+    Pong comes back, with the Pong as its value.  If timeout seconds go by
+    first, its value is None.  Scripts can yield it (see sim/tasks.py).
+    """
+    import tasks
+    if not hasattr(self, '_waiting'):
+      self._waiting = {} # Ping number -> Future
+      self._pings = 0
+    self._pings += 1
+    n = self._pings
+    f = self._waiting[n] = tasks.Future()
+    if timeout is not None:
+      def expire ():
+        self._waiting.pop(n, None)
+        f.set(None)
+      create_timer(timeout, expire, recurring=False)
+    p = Ping(dst, data=data)
+    p.waiter = n
+    self.send(p, flood=True)
+    return f
+
   def handle_rx (self, packet, port):
     """
     Silently drops messages to nobody.
@@ -27,18 +50,31 @@ class BasicHost (HostEntity):
       if type(packet) is Ping:
         # Trace this path
         import core
-        core.events.highlight_path([packet.src] + packet.trace)
+        core.topoOf(self).sim.events.highlight_path([packet.src] +
+                                                    packet.trace)
         # Send a pong response
         self.send(Pong(packet), port)
+      elif type(packet) is Pong:
+        n = getattr(packet.original, 'waiter', None)
+        if n is not None and hasattr(self, '_waiting'):
+          f = self._waiting.pop(n, None)
+          if f is not None: f.set(packet)
 
 
 class Ping (Packet):
   """ A Ping packet """
+  __slots__ = ('data', 'waiter')
+  _ALPHA = 1 # Full opacity
+  _INNER = (1,1,1,1) # white
+
   def __init__ (self, dst, data=None):
     Packet.__init__(self, dst=dst)
     self.data = data
-    self.outer_color[3] = 1 # Full opacity
-    self.inner_color = [1,1,1,1] # white
+
+  def wire_size (self):
+    if self.data is None:
+      return self._SIZE
+    return self._SIZE + len(str(self.data))
 
   def __repr__ (self):
     d = self.data
@@ -54,6 +90,8 @@ class Pong (Packet):
   A Pong packet.  It's a returned Ping.  The original Ping is in
   the .original property.
   """
+  __slots__ = ('original',)
+
   def __init__ (self, original):
     Packet.__init__(self, dst=original.src)
     self.original = original
@@ -85,6 +123,8 @@ class DiscoveryPacket (Packet):
     A "link latency change" packet.
     latency should be float("inf") if the link is down.
     """
+    __slots__ = ('latency', 'is_link_up')
+
     def __init__(self, src, latency):
         Packet.__init__(self, src=src)
         self.latency = latency
@@ -101,6 +141,7 @@ class RoutingUpdate (Packet):
     """
     A Routing Update message to use with your DVRouter implementation.
     """
+    __slots__ = ('paths',)
 
     def __init__(self):
         Packet.__init__(self)
@@ -110,6 +151,10 @@ class RoutingUpdate (Packet):
         """
         Add a destination to announce, along with senders distance to that dest.
         """
+        if self._shared:
+          # Copies of a sent packet share its paths
+          self.paths = dict(self.paths)
+          self._shared = False
         self.paths[dest] = distance
 
     def get_distance(self, dest):
@@ -118,6 +163,12 @@ class RoutingUpdate (Packet):
         """
         return self.paths[dest]
 
+    def wire_size(self):
+        """
+        Each destination takes 8 bytes (its address and distance).
+        """
+        return self._SIZE + 8 * len(self.paths)
+
     def all_dests(self):
         """
         Get a list of all destinations with paths announced in this message.
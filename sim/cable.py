@@ -1,6 +1,6 @@
-import random
-from core import world
-from core import events
+import collections
+
+import spill
 
 #default_latency = 0.5
 
@@ -25,6 +25,12 @@ class Cable (object):
     self.dst = dst
     self.dstPort = dstport
     self.dstEnt = dst.entity
+    self.world = src.sim.world
+    self.events = src.sim.events
+    self.random = src.sim.stream("cable", self.srcEnt.name, srcport)
+    import api
+    self.batched = (type(self.dstEnt).handle_rx_batch.im_func
+                    is not api.Entity.handle_rx_batch.im_func)
 
   def transfer (self, packet):
     """ Implement this in subclasses. """
@@ -46,14 +52,34 @@ class BasicCable (Cable):
     else:
       self.latency = default_latency
 
+  def initialize (self, src, srcport, dst, dstport):
+    super(BasicCable, self).initialize(src, srcport, dst, dstport)
+    import fifo
+    self.fifo = fifo.Fifo(self.world) # The packets in flight
+
   def transfer (self, packet):
-    def rx ():
-      packet.mark(self.dstEnt) #FIXME: do this somewhere more convenient
-      self.dstEnt.handle_rx(packet, self.dstPort)
+    world = self.world
+    if not world.guard.admit(self.dstEnt, packet):
+      return
 
-    world.doLater(self.latency, rx)
+    if not self.fifo.post(self.latency, self._deliver, (packet, True)):
+      world.post(self.latency, self._deliver, (packet,))
+    if world.tracer is not None:
+      world.tracer.transfer(self, packet)
 
-    events.packet(self.srcEnt.name, self.dstEnt.name, packet, self.latency)
+    if self.events.listening and not world.shedding:
+      self.events.packet(self.srcEnt.name, self.dstEnt.name, packet,
+                         self.latency)
+
+  @spill.owns # Nothing else refers to a packet on a cable
+  def _deliver (self, packet, queued = False):
+    if queued:
+      self.fifo.done()
+    packet.mark(self.dstEnt) #FIXME: do this somewhere more convenient
+    if self.batched:
+      self.world.deliver_batched(self.dstEnt, packet, self.dstPort)
+    else:
+      self.dstEnt.handle_rx(packet, self.dstPort)
 
 
 class UnreliableCable (BasicCable):
@@ -79,9 +105,106 @@ class UnreliableCable (BasicCable):
     self.drop = drop
 
   def transfer (self, packet):
-    if random.random() >= self.drop:
+    if self.random.random() >= self.drop:
       super(UnreliableCable, self).transfer(packet)
-    else:
-      events.packet(self.srcEnt.name, self.dstEnt.name, packet,
-                    self.latency, drop=True)
+      return
+    world = self.world
+    if world.tracer is not None:
+      world.tracer.transfer(self, packet, dropped=True)
+    if self.events.listening and not world.shedding:
+      self.events.packet(self.srcEnt.name, self.dstEnt.name, packet,
+                         self.latency, drop=True)
+
+
+
+class BandwidthCable (BasicCable):
+  """
+  A cable with a bandwidth as well as a latency.  Each packet takes
+  packet.wire_size() * 8 / bandwidth seconds to send, one at a time, and
+  waits in a queue while the ones before it are sent.  If there are
+  already queue_size packets waiting, it's dropped.  stats() returns what
+  the cable has carried (topo.show_ports() shows it too).
+  """
+  @classmethod
+  def pair (cls, latency = None, bandwidth = 1e6, queue_size = 100):
+    """ Create a pair of these (one for each direction) """
+    return ( cls(latency = latency, bandwidth = bandwidth,
+                 queue_size = queue_size),
+             cls(latency = latency, bandwidth = bandwidth,
+                 queue_size = queue_size) )
+
+  def __init__ (self, latency = None, bandwidth = 1e6, queue_size = 100):
+    """
+    bandwidth is in bits per second (1Mb/s by default)
+    """
+    super(BandwidthCable, self).__init__(latency = latency)
+    self.bandwidth = bandwidth
+    self.queue_size = queue_size
+
+  def initialize (self, src, srcport, dst, dstport):
+    super(BandwidthCable, self).initialize(src, srcport, dst, dstport)
+    self._starts = collections.deque() # When queued packets start sending
+    self._free_at = 0 # When the last packet will have been sent
+    self.since = self.world.time()
+    self.bytes = 0
+    self.packets = 0
+    self.drops = 0
+    self.max_queued = 0
+    self.busy = 0 # Seconds spent sending, including what's queued
+
+  def queued (self):
+    """ Returns how many packets are waiting to be sent """
+    now = self.world.time()
+    starts = self._starts
+    while starts and starts[0] <= now:
+      starts.popleft()
+    return len(starts)
+
+  def utilization (self):
+    """ Returns the fraction of the time the cable has been sending """
+    now = self.world.time()
+    if now <= self.since: return 0.0
+    return (self.busy - max(0, self._free_at - now)) / (now - self.since)
+
+  def stats (self):
+    return {'bytes' : self.bytes, 'packets' : self.packets,
+            'drops' : self.drops, 'queued' : self.queued(),
+            'max_queued' : self.max_queued,
+            'utilization' : self.utilization()}
+
+  def transfer (self, packet):
+    world = self.world
+    if not world.guard.admit(self.dstEnt, packet):
+      return
+
+    queued = self.queued()
+    if queued >= self.queue_size:
+      self.drops += 1
+      if world.tracer is not None:
+        world.tracer.transfer(self, packet, dropped=True)
+      if self.events.listening and not world.shedding:
+        self.events.packet(self.srcEnt.name, self.dstEnt.name, packet,
+                           self.latency, drop=True)
+      return
+
+    now = world.time()
+    size = packet.wire_size()
+    start = max(now, self._free_at)
+    sending = size * 8.0 / self.bandwidth
+    self._free_at = start + sending
+    if start > now:
+      self._starts.append(start)
+      self.max_queued = max(self.max_queued, queued + 1)
+    self.bytes += size
+    self.packets += 1
+    self.busy += sending
+
+    # Packets arrive in the order they're sent, so they can go in the Fifo
+    delay = self._free_at + self.latency - now
+    if not self.fifo.post(delay, self._deliver, (packet, True)):
+      world.post(delay, self._deliver, (packet,))
+    if world.tracer is not None:
+      world.tracer.transfer(self, packet)
 
+    if self.events.listening and not world.shedding:
+      self.events.packet(self.srcEnt.name, self.dstEnt.name, packet, delay)
@@ -0,0 +1,174 @@
+"""
+Saves a running simulation to a file and restores it later.
+Students should not need to use this.
+
+A checkpoint holds everything in a Simulation: the World's pending events
+(packets on cables, timers, scheduled calls), the entities and all their
+state (routing tables and so on), and the TopoNodes and cables that
+connect them.  For example, to converge a big topology once and then try
+lots of failures from there:
+  checkpoint.save("converged.ckpt")
+  ...
+  checkpoint.restore("converged.ckpt")
+  sim.core.simulate(virtual = True, threaded = False)
+  topo.unlink(s1, s2)
+  sim.core.run_until_quiescent()
+
+A restored simulation starts out stopped, with its clock at the time it
+was saved, so start it again with simulate().  By default, it replaces the
+default simulation (and gets its interface to the GUI); otherwise, it's a
+separate Simulation of its own.
+
+The entities' classes must be importable under the same names when the
+checkpoint is restored, including those in __main__ (so restore from the
+same script that saved).  Functions that aren't defined at the top level
+of a module -- lambdas and closures in timers and scheduled events -- are
+saved along with their code, and so must be restored by the same version
+of the code.  (Filling in their closures uses the CPython API, through
+ctypes.)  Profiling, tracing and spilling to disk aren't saved, and a
+World that spills to disk can't be checkpointed.
+"""
+
+import sys
+import types
+import ctypes
+import marshal
+import pickle
+import cPickle
+
+import core
+
+
+class _Empty (object):
+  """ Stands for the value of a cell that hasn't been set yet """
+
+def _make_cell ():
+  if False:
+    value = None
+  return (lambda: value).func_closure[0]
+
+def _make_function (code, module, name, defaults, cells):
+  """
+  Makes a function whose closure is /cells/ empty cells, which are filled
+  in by _fill_function() (once the function has been memoized, since what
+  they hold can refer back to it)
+  """
+  g = sys.modules[module].__dict__ if module in sys.modules else {}
+  closure = None
+  if cells is not None:
+    closure = tuple(_make_cell() for i in range(cells))
+  return types.FunctionType(marshal.loads(code), g, name, defaults, closure)
+
+def _fill_function (func, values):
+  for cell, value in zip(func.func_closure, values):
+    if value is not _Empty:
+      ctypes.pythonapi.PyCell_Set(ctypes.py_object(cell),
+                                  ctypes.py_object(value))
+  return func
+
+def _cell_value (cell):
+  try:
+    return cell.cell_contents
+  except ValueError:
+    return _Empty
+
+
+class Pickler (pickle.Pickler):
+  """ A Pickler that can save lambdas and closures too """
+  dispatch = pickle.Pickler.dispatch.copy()
+
+  def __init__ (self, f, sim):
+    pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+    self.sim = sim
+
+  def persistent_id (self, obj):
+    if obj is core.NullAddress: return "NullAddress"
+    if obj is self.sim.events and obj is not None: return "events"
+    return None
+
+  def save_function (self, obj):
+    try:
+      return self.save_global(obj)
+    except pickle.PicklingError:
+      pass
+    closure = obj.func_closure
+    make = (marshal.dumps(obj.func_code), obj.__module__, obj.func_name,
+            obj.func_defaults, None if closure is None else len(closure))
+    if closure is None:
+      self.save_reduce(_make_function, make, obj = obj)
+      return
+    # _fill_function(<the function>, <the values in its cells>), with the
+    # function remembered before the values are saved, so that a closure
+    # that refers to itself (or something that refers to it) works
+    self.save(_fill_function)
+    self.write(pickle.MARK)
+    self.save_reduce(_make_function, make, obj = obj)
+    self.save(tuple(_cell_value(c) for c in closure))
+    self.write(pickle.TUPLE)
+    self.write(pickle.REDUCE)
+
+  dispatch[types.FunctionType] = save_function
+
+  def save_method (self, obj):
+    # As what it's a method of and its name
+    of = obj.im_self if obj.im_self is not None else obj.im_class
+    self.save_reduce(getattr, (of, obj.im_func.__name__), obj = obj)
+
+  dispatch[types.MethodType] = save_method
+
+
+def save (path, sim = None):
+  """
+  Saves a Simulation (by default, the current one) to path.
+  If it's running in its own thread, it's saved between events.  Don't
+  call this from an event handler.
+  """
+  if sim is None: sim = core.current()
+  def write ():
+    f = open(path, 'wb')
+    try:
+      Pickler(f, sim).dump(sim)
+    finally:
+      f.close()
+  sim.world.between(write)
+
+
+def restore (path, as_default = True):
+  """
+  Restores the Simulation saved in path and returns it.
+  If as_default is True, it replaces the default simulation: core.world
+  and core.topo become its, and so do the names of the entities.  The old
+  default World's thread, if it has one, is stopped first (so don't call
+  this from an event handler).
+  """
+  if as_default:
+    events = core.default.events
+  else:
+    import comm
+    events = comm.NullInterface()
+
+  def load (pid):
+    if pid == "NullAddress": return core.NullAddress
+    if pid == "events": return events
+    raise cPickle.UnpicklingError("Unknown persistent id " + repr(pid))
+
+  f = open(path, 'rb')
+  try:
+    u = cPickle.Unpickler(f)
+    u.persistent_load = load
+    sim = u.load()
+  finally:
+    f.close()
+
+  sim.events = events
+
+  if as_default:
+    core.default.world.stop() # Or it would go on running the old one
+    sim.register = True
+    core.default = sim
+    core.world = sim.world
+    core.topo = sim.topo
+  if sim.register:
+    for name, e in sim.entities.iteritems():
+      sys.modules['__builtin__'].__dict__[name] = e
+  return sim
@@ -5,6 +5,10 @@ programs that various events have occurred.
 
 class NullInterface (object):
   """ Interface that does nothing / base class """
+  # Whether anything is listening to packet() (which is called a lot, so
+  # cables only call it if so)
+  listening = False
+
   def send_console(self, text):
     pass
 
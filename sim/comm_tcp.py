@@ -13,6 +13,11 @@ import core
 import api
 
 class StreamingConnection (comm.NullInterface):
+  # These control the world's clock, so they're handled right away rather
+  # than being queued up behind everything else (which would never happen
+  # while the world is paused).
+  _immediate = set(['_handle_pause', '_handle_speed', '_handle_step'])
+
   def __init__ (self, parent, sock):
     self.sock = sock
     self.parent = parent
@@ -80,7 +85,10 @@ class StreamingConnection (comm.NullInterface):
               methodName = "_handle_" + data.get('type', "<UNDEFINED>")
               m = getattr(self, methodName)
               del data['type']
-              core.world.doLater(0, m, **data)
+              if methodName in self._immediate:
+                m(**data)
+              else:
+                core.world.doLater(0, m, **data)
             except:
               core.simlog.error("Error dispatching " + methodName)
               traceback.print_exc()
@@ -113,6 +121,24 @@ class StreamingConnection (comm.NullInterface):
       if node1.isConnectedTo(node2):
         node1.unlinkTo(node2)
 
+  def _handle_pause (self, paused = True):
+    if paused:
+      core.world.pause()
+    else:
+      core.world.resume()
+
+  def _handle_speed (self, factor):
+    core.world.set_speed(factor)
+
+  def _handle_step (self, count = 1):
+    if core.world._thread is None:
+      # Stepping here would dispatch events in this thread, while whoever
+      # is running the world may be doing so too
+      core.simlog.warning("Can't step a world without a thread of its own "
+                          "from the GUI")
+      return
+    core.world.step(count)
+
   def _handle_disconnect (self, node):
     node = core._getByName(node)
     if node:
@@ -143,6 +169,11 @@ class StreamingInterface (object):
 
     self.connections = []
 
+  @property
+  def listening (self):
+    """ Whether any GUIs are connected (see comm.NullInterface) """
+    return bool(self.connections)
+
   def _listenLoop (self):
     import select
     try:
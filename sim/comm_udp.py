@@ -10,6 +10,8 @@ import socket
 import json
 
 class GuiInterface(comm.NullInterface):
+  listening = True
+
   def __init__ (self):
     self.recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.recv.bind(("127.0.0.1", 4445))
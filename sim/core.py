@@ -9,18 +9,31 @@ grading.
 import comm_tcp as interface
 #import comm_udp as interface
 #import comm as interface
+import comm
 
 import sys
 import sim
-import copy
 import threading
-import Queue
+import thread
+import heapq
 import time
 import weakref
+import collections
+import atexit
+import random
+import hashlib
 
 import logging
 import traceback
 
+from wheel import TimerWheel
+from lateness import LatenessMonitor
+from guard import StormGuard
+import profiler
+import tracer
+import spill
+import replay
+
 class EventLogger (logging.Handler):
   _attributes = [
     'created','filename','funcName','levelname','levelno','lineno',
@@ -78,6 +91,12 @@ class Interp (code.InteractiveInterpreter):
 
 interp = Interp(sys.modules['__main__'].__dict__)
 
+# Python 2 has no monotonic clock, so fall back to the wall clock there
+_monotonic = getattr(time, 'monotonic', time.time)
+
+# The keyword arguments of events that don't have any (see World.post())
+_NOKW = {}
+
 class NullAddressType (object):
   """
   There is one instance of this: NullAddress
@@ -98,16 +117,19 @@ class Timer (object):
   You should just create this with api.create_timer()."""
   def __init__ (self, seconds, target=None, args=(), kw={}, passSelf=False):
     self.seconds = seconds
-    world.doLater(seconds, self.timeout)
     self.func = target
     self.stopped = False
     self.args = list(args)
     self.kw = dict(kw)
     if passSelf:
       self.args = [self] + self.args
+    self._slot = None
+    self.world = current().world
+    self.world.timers.add(self, seconds)
 
   def cancel (self):
     self.stopped = True
+    self.world.timers.cancel(self)
 
   def timer (self):
     if self.func:
@@ -117,8 +139,8 @@ class Timer (object):
     if self.stopped: return
     try:
       rv = self.timer()
-      if rv is not False:
-        world.doLater(self.seconds, self.timeout)
+      if rv is not False and not self.stopped:
+        self.world.timers.add(self, self.seconds)
     except:
       simlog.error("Exception while executing a timer")
       traceback.print_exc()
@@ -137,10 +159,89 @@ class OneShot (Timer):
 
 class World (object):
   """ Mostly this dispatches events in the simulator. """
-  def __init__ (self):
-    self.queue = Queue.PriorityQueue()
+  MIN_SPEED = 0.1
+  MAX_SPEED = 100.0
+
+  def __init__ (self, virtual = False):
+    # The Simulation this world belongs to.  While it's dispatching events,
+    # it's the current one.
+    self.sim = None
+
+    # Pending events are (time, count, method, args, kw) tuples in a heap.
+    # The count breaks ties so that events at the same time run in the
+    # order they were scheduled.  _clock protects the heap and wakes up the
+    # world thread when something earlier than what it's waiting for shows
+    # up.
+    self._heap = []
+    self._clock = threading.Condition()
     self._thread = None
+    self._started = False
+
+    # Only the thread dispatching events (the world thread, or whoever is
+    # calling run_until() and friends) touches the heap.  Other threads
+    # append (time, method, args, kw) to the inbox, and the dispatcher
+    # moves everything in it to the heap in one go on each pass.  They
+    # only need the lock to wake the dispatcher if it's waiting.
+    self._owner = None
+    self._inbox = collections.deque()
+    self._waiting = False
+    self._between = collections.deque() # See between()
     self._count = 0
+    self._epoch = None
+    self._in_fifos = 0 # Events waiting in cables' Fifos (see sim/fifo.py)
+
+    # Events at or after _spillAt go to the SpillQueue (if there is one)
+    # instead of the heap.  See spill_to_disk().
+    self.spill = None
+    self._spillAt = float("inf")
+
+    # In real time, the simulated clock runs /speed/ times as fast as the
+    # wall clock.  It stands still while paused, except that step() lets
+    # the next few events through, jumping the clock forward to each.
+    self.speed = 1.0
+    self.paused = False
+    self._steps = 0
+
+    # In virtual time, the clock jumps straight to the next event instead
+    # of waiting for the wall clock to catch up with it.  The clock only
+    # advances as far as the horizon, which is pushed forward by sleep().
+    self.virtual = virtual
+    self._now = 0.0
+    self._horizon = 0.0
+    self._idle = False
+    self._halted = False
+
+    # Timers live in a timing wheel, which keeps a single wakeup event in
+    # the queue no matter how many timers are pending.
+    self.timers = TimerWheel(self)
+
+    # In real time, we keep track of how late events run.  If they get too
+    # late, the monitor may ask us to stop animating packets in the GUI
+    # (shedding) or to switch to virtual time.
+    self.lateness = LatenessMonitor(self)
+    self.shedding = False
+
+    # Keeps broadcast storms from filling up the queue, and samples the
+    # queue's depth every depth_interval simulated seconds.
+    self.guard = StormGuard(self)
+    self.depth_interval = 1.0
+    self.depth_history = collections.deque(maxlen = 3600)
+    self._next_sample = 0.0
+
+    # Monitors have before() and after() called around every event that's
+    # dispatched.  The profiler and the tracer are monitors.
+    self.monitors = []
+    self.profiler = None
+    self.tracer = None
+    self.journaler = None
+
+    # Called when there's nothing left to do.  See when_quiescent().
+    self._quiet = []
+
+    # Packets that have arrived at entities with a handle_rx_batch(), and
+    # are waiting for the rest of those arriving at the same time.  See
+    # deliver_batched().
+    self._rx = {} # Entity -> [(packet, port)]
 
     # When the world isn't running, items are put in the prelist.
     # They're added to the queue when the world is started, and
@@ -148,74 +249,691 @@ class World (object):
     # when the world was started, NOT to when they were added.
     self._prelist = []
 
+  def time (self):
+    """ Returns the current simulator time in seconds since the start. """
+    if self.virtual or self.paused or self._epoch is None:
+      return self._now
+    return self._now + (_monotonic() - self._epoch) * self.speed
+
+  def _rebase (self):
+    """ Folds the time elapsed so far into _now.  Call with _clock held. """
+    if self._epoch is not None:
+      self._now = self.time()
+      self._epoch = _monotonic()
+
+  def set_speed (self, factor):
+    """
+    Sets how many simulated seconds pass per real second.
+    It's clamped to between MIN_SPEED and MAX_SPEED.  This has no effect
+    in virtual time, which runs as fast as it can anyway.
+    """
+    factor = min(max(float(factor), self.MIN_SPEED), self.MAX_SPEED)
+    with self._clock:
+      self._rebase()
+      self.speed = factor
+      self._clock.notifyAll()
+
+  def pause (self):
+    """ Stops the real-time clock.  Nothing more is dispatched until resume(). """
+    with self._clock:
+      if self.paused: return
+      self._rebase()
+      self.paused = True
+      self._clock.notifyAll()
+
+  def resume (self):
+    """ Restarts the clock after pause(). """
+    with self._clock:
+      if not self.paused: return
+      self.paused = False
+      self._steps = 0
+      if self._epoch is not None:
+        self._epoch = _monotonic()
+      self._clock.notifyAll()
+
+  def step (self, count = 1):
+    """
+    Runs the next /count/ events.
+    If the world has a thread of its own, this only works while paused,
+    and the clock jumps forward to each event.  Otherwise, the events are
+    run in the calling thread.  Returns the number of events run (or
+    queued up to run, for the world thread).
+    """
+    if self._thread is not None:
+      with self._clock:
+        if not self.paused: return 0
+        self._steps += count
+        self._clock.notifyAll()
+      return count
+    self._sync()
+    for n in xrange(count):
+      batch = self._next_batch(limit = float("inf"), single = True)
+      if not batch: return n
+      self._run_batch(batch)
+    return count
+
   def _real_doLater (_self, _seconds, _method, *_args, **_kw):
-    t = time.time() + _seconds
-    _self.queue.put((t, _self._count, _method, _args, _kw))
-    _self._count += 1
+    _self._schedule(_self.time() + _seconds, _method, _args, _kw)
+
+  def _schedule (self, t, method, args, kw):
+    if thread.get_ident() != self._owner:
+      self._inbox.append((t, method, args, kw))
+      if self._waiting:
+        with self._clock:
+          self._clock.notifyAll()
+      return
+    self._push((t, self._count, method, args, kw))
+    self._count += 1
+
+  def _push (self, record):
+    if record[0] < self._spillAt:
+      heapq.heappush(self._heap, record)
+    else:
+      self.spill.push(record)
+
+  def post (self, seconds, method, args):
+    """
+    Like doLater(seconds, method, *args), for things that schedule lots of
+    events (like cables delivering packets): the arguments are already a
+    tuple, there are no keyword arguments, and nothing is built on the way.
+    """
+    if self._started:
+      self._schedule(self.time() + seconds, method, args, _NOKW)
+    else:
+      self._prelist.append((seconds, method, args, _NOKW))
 
-  def start (self):
-    assert self._thread is None
+  def doAt (_self, _t, _method, *_args, **_kw):
+    """
+    Schedules a call at simulated time t.  Unlike doLater(), the time is
+    used exactly as given.  The world must have been started.
+    """
+    assert _self._started
+    _self._schedule(_t, _method, _args, _kw)
+
+  def between (self, func):
+    """
+    Calls func in the thread that dispatches events, between batches of
+    them (so that nothing is half done), and returns what it returns.
+    """
+    if self._thread is None or not self._thread.is_alive():
+      return func()
+    if thread.get_ident() == self._owner:
+      raise RuntimeError("Can't wait for the world thread from itself")
+    done = threading.Event()
+    result = []
+    def call ():
+      try:
+        result.append((True, func()))
+      except:
+        result.append((False, sys.exc_info()))
+      done.set()
+    with self._clock:
+      self._between.append(call)
+      self._clock.notifyAll()
+    done.wait()
+    ok, r = result[0]
+    if not ok:
+      raise r[0], r[1], r[2]
+    return r
+
+  # The parts of a World that aren't saved in a checkpoint
+  _TRANSIENT = ('_clock', '_thread', '_owner', '_inbox', '_waiting',
+                '_between', 'monitors', 'profiler', 'tracer', 'journaler',
+                '_quiet')
+
+  def __getstate__ (self):
+    if self.spill is not None:
+      raise RuntimeError("Can't checkpoint a World that spills to disk")
+    self._drain()
+    d = self.__dict__.copy()
+    for k in self._TRANSIENT:
+      del d[k]
+    # It comes back stopped, at the time it was saved
+    d['_now'] = d['_horizon'] = self.time()
+    d['_epoch'] = None
+    d['_started'] = False
+    d['_idle'] = d['_halted'] = False
+    d['_steps'] = 0
+    return d
+
+  def __setstate__ (self, d):
+    self.__dict__.update(d)
+    self._clock = threading.Condition()
+    self._thread = None
+    self._owner = None
+    self._inbox = collections.deque()
+    self._waiting = False
+    self._between = collections.deque()
+    self.monitors = []
+    self.profiler = None
+    self.tracer = None
+    self.journaler = None
+    self._quiet = []
+
+  def next_time (self):
+    """
+    Returns the time of the next pending event (or infinity).
+    Call it from the thread that's dispatching events.
+    """
+    with self._clock:
+      self._drain()
+      if self.spill is not None:
+        self._page_in()
+      return self._heap[0][0] if self._heap else float("inf")
+
+  def _drain (self):
+    """ Moves everything from the inbox to the heap """
+    inbox = self._inbox
+    while inbox:
+      t, method, args, kw = inbox.popleft()
+      self._push((t, self._count, method, args, kw))
+      self._count += 1
+
+  def _page_in (self):
+    """ Loads spilled events back when the heap runs out of earlier ones """
+    heap = self._heap
+    for e in self.spill.flush():
+      heapq.heappush(heap, e) # It couldn't be pickled
+    while self.spill.count and (not heap or heap[0][0] >= self._spillAt):
+      events, self._spillAt = self.spill.load()
+      for e in events:
+        heapq.heappush(heap, e)
+
+  def spill_to_disk (self, directory = None, width = 10.0,
+                     buffer_size = 1 << 20):
+    """
+    Keeps events more than a bucket of /width/ simulated seconds ahead on
+    disk (in directory, or a temporary one) instead of in memory.  This
+    is for simulations so big that their queue doesn't fit in memory.
+    See sim/spill.py.
+    """
+    with self._clock:
+      if self.spill is not None: return self.spill
+      self.spill = spill.SpillQueue(directory, width, buffer_size)
+      self._spillAt = self.spill.boundary(self.time())
+      if self._in_fifos:
+        # Packets queued on cables can be spilled too
+        for te in self.sim.topo.values():
+          for cable in te.ports:
+            fifo = getattr(cable, 'fifo', None)
+            if fifo is not None: fifo.flush()
+      return self.spill
+
+  def _wait (self, timeout = None):
+    """ Waits to be notified.  Call with _clock held. """
+    self._waiting = True
+    if not self._inbox and not self._between:
+      self._clock.wait(timeout)
+    self._waiting = False
+
+  def apply_at (self, t, edits):
+    """
+    Applies a list of edits at simulated time t, all in a single event.
+    Each edit is a function or a (function, arg, ...) tuple, e.g.,
+    (topo.unlink, s1, s2).  Since they're applied together and in order,
+    no other event ever sees the topology halfway through them.
+    This is safe to call from any thread.
+    """
+    edits = [(e[0], e[1:]) if isinstance(e, tuple) else (e, ())
+             for e in edits]
+    self.doLater(max(0, t - self.time()), self._apply, edits)
+
+  def _apply (self, edits):
+    for func, args in edits:
+      func(*args)
+
+  def start (self, threaded = True):
+    """
+    Starts the world.
+    Normally, events are dispatched by a thread of the world's own.  If
+    threaded is False, nothing happens until you call run_until(),
+    run_until_quiescent() or step(), which dispatch events in the
+    calling thread.
+    """
+    assert not self._started
 
+    self._started = True
+    self._epoch = _monotonic()
+    self._owner = thread.get_ident()
     for a,b,c,d in self._prelist:
       self._real_doLater(a, b, *c, **d)
     self._prelist = []
 
+    if not threaded: return
+    self._owner = None
     self._thread = threading.Thread(target=self.run)
     self._thread.daemon = True
     self._thread.start()
 
+  def stop (self):
+    """
+    Stops the world's own thread once it has finished the events it's
+    running, and waits for it.  Does nothing if it doesn't have one.
+    The world can't be started again.
+    """
+    t = self._thread
+    if t is None: return
+    assert t.ident != thread.get_ident(), "The world can't stop itself"
+    with self._clock:
+      self._halted = True
+      self._clock.notifyAll()
+    t.join()
+
+  def _foreign (self):
+    """
+    Returns True if the world has a thread of its own and this isn't it
+    (so things it dispatches from mustn't be changed from here).
+    """
+    return self._thread is not None and thread.get_ident() != self._owner
+
+  def _sync (self):
+    """ Gets ready to dispatch events in the calling thread """
+    assert self._thread is None, "The world is running in its own thread"
+    if not self._started:
+      self.start(threaded = False)
+    self._owner = thread.get_ident()
+
+  def run_until (self, t, exclusive = False):
+    """
+    Runs everything up to simulated time t in the calling thread.
+    In virtual time, the clock is then at t.  In real time, this takes
+    until t actually comes around.
+    If exclusive is True, events at exactly t are left (in virtual time).
+    """
+    self._sync()
+    while True:
+      batch = self._next_batch(limit = t, exclusive = exclusive)
+      if not batch: break
+      self._run_batch(batch)
+
+  def run_for (self, seconds):
+    """ Runs for the given number of simulated seconds """
+    self.run_until(self.time() + seconds)
+
+  def run_until_quiescent (self, max_time = None, timers = False):
+    """
+    Runs until there is nothing left to do, and returns True.
+    If simulated time max_time comes around first, returns False.
+    Pending timers don't count as something to do unless /timers/ is
+    True, since a recurring timer never lets the queue drain.
+    """
+    self._sync()
+    limit = float("inf") if max_time is None else max_time
+    while not self.quiescent(timers):
+      batch = self._next_batch(limit = limit, single = True)
+      if not batch: return False
+      self._run_batch(batch)
+    return True
+
+  def run_until_done (self, future, max_time = None):
+    """
+    Runs in the calling thread until future (see sim/tasks.py) has
+    happened, and returns True.  Returns False if simulated time max_time
+    comes around first, or if there's nothing left that could make it
+    happen.  If the world has a thread of its own, this just waits for it
+    (letting it run up to max_time, in virtual time).
+    """
+    if self._thread is not None:
+      return self._wait_until_done(future, max_time)
+    self._sync()
+    limit = float("inf") if max_time is None else max_time
+    while not future.done:
+      batch = self._next_batch(limit = limit, single = True)
+      if not batch: return False
+      self._run_batch(batch)
+    return True
+
+  def _wait_until_done (self, future, max_time):
+    if not self.virtual:
+      timeout = None
+      if max_time is not None:
+        timeout = max(0, max_time - self.time()) / self.speed
+      return future.wait(timeout)
+    def stop (_):
+      with self._clock:
+        self._horizon = self._now
+        self._clock.notifyAll()
+    with self._clock:
+      self._horizon = float("inf") if max_time is None else max_time
+      self._idle = False
+      self._clock.notifyAll()
+    future.add_callback(stop)
+    with self._clock:
+      while not (future.done or self._idle or self._halted):
+        self._clock.wait()
+      if not future.done:
+        if max_time is not None:
+          self._now = max(self._now, float(max_time))
+        self._horizon = self._now
+    return future.done
+
+  def deliver_batched (self, entity, packet, port):
+    """
+    Gives a packet to entity.handle_rx_batch() along with the others that
+    arrive at the same time.  The batch is handed over in an event at the
+    current time, so it runs after everything already due now.
+    """
+    pending = self._rx.get(entity)
+    if pending is None:
+      pending = self._rx[entity] = []
+      self.doLater(0, self._flush_rx, entity)
+    pending.append((packet, port))
+
+  def _flush_rx (self, entity):
+    entity.handle_rx_batch(self._rx.pop(entity))
+
+  def when_quiescent (self, func):
+    """
+    Calls func() after the next event after which there's nothing left to
+    do (not counting timers).  Call it from an event.
+    """
+    self._quiet.append(func)
+
+  def quiescent (self, timers = False):
+    """ Returns True if nothing is pending (optionally ignoring timers) """
+    pending = len(self._heap) + len(self._inbox) + self._in_fifos
+    if self.spill is not None:
+      pending += self.spill.count
+    if not timers:
+      pending -= self.timers.queued
+    return pending <= 0
+
   def do (self, _method, *args, **kw):
     self.doLater(0, _method, *args, **kw)
 
   def doLater (_self, _seconds, _method, *_args, **_kw):
-    if _self._thread is not None:
+    if _self._started:
       _self._real_doLater(_seconds, _method, *_args, **_kw)
     else:
       _self._prelist.append((_seconds, _method, _args, _kw))
 
-  def run (self):
-    timeout = None
-    waiting = Queue.PriorityQueue()
+  def sleep (self, seconds):
+    """
+    Lets the simulation run for the given number of seconds.
+    In real time, this is just time.sleep() (unless the world was started
+    without a thread of its own, when it dispatches events meanwhile).  In
+    virtual time, it advances the clock and returns as soon as everything
+    up to then has run.
+    """
+    if not self.virtual:
+      if self._thread is None and self._started:
+        self.run_for(seconds)
+        return
+      if self._thread is None or (self.speed == 1 and not self.paused):
+        time.sleep(seconds)
+        return
+      end = self.time() + seconds
+      while True:
+        left = end - self.time()
+        if left <= 0: break
+        time.sleep(min(left / self.speed, 0.05))
+      return
+    if self._thread is None:
+      self.run_for(seconds)
+      return
+    with self._clock:
+      self._horizon = max(self._horizon, self._now) + seconds
+      self._idle = False
+      self._clock.notifyAll()
+      while not (self._idle or self._halted):
+        self._clock.wait()
+      self._now = max(self._now, self._horizon)
 
-    while True:
-      try:
-        t = time.time()
-        while not waiting.empty():
-          o = waiting.get()
-          if o[0] <= t:
-            self.queue.put(o)
-            timeout = None
-          else:
-            waiting.put(o)
-            o = waiting.get()
-            waiting.put(o)
-            timeout = o[0] - t
+  def run (self):
+    self._owner = thread.get_ident()
+    try:
+      self._dispatch()
+    except:
+      simlog.error("Exception in the world thread")
+      traceback.print_exc()
+    finally:
+      # Don't leave anyone sleeping on a world that has died
+      with self._clock:
+        self._idle = True
+        self._halted = True
+        self._clock.notifyAll()
+      if self.profiler is not None:
+        self.profiler.dump()
+      self.stop_trace()
+      self.stop_journal()
+
+  def _next_batch (self, limit = None, single = False, exclusive = False):
+    """
+    Waits until something is due and pops everything that is.
+    In real time, that's every event whose time has passed.  In virtual
+    time, it's every event at the next timestamp.  If single is True,
+    it's just the first of those.
+    If limit is given, returns an empty list rather than waiting for
+    anything later than that (or waiting forever on an empty queue).
+    In virtual time, exclusive means not even waiting for the limit.
+    """
+    heap = self._heap
+    with self._clock:
+      while True:
+        if self._halted: return [] # Told to stop()
+        self._drain()
+        while self._between:
+          self._between.popleft()()
+        if self.spill is not None:
+          self._page_in()
+        if self.virtual:
+          horizon = self._horizon if limit is None else limit
+          if heap and (heap[0][0] < horizon if exclusive
+                       else heap[0][0] <= horizon):
             break
-        #print "World waiting for",timeout
-
-        o = self.queue.get(True, timeout)
-      except:
-        #print "empty"
-        continue
-
-      t = time.time()
-      if o[0] > t:
-        # Hasn't expired yet...
-        #print "recycle"
-        waiting.put(o)
-        o = waiting.get()
-        waiting.put(o)
-        timeout = o[0] - t
-        continue
-      # Expired
-      timeout = None
-      if False:
-        if hasattr(o[2], "im_self"):
-          print o[2].im_self.__class__.__name__ + "." + o[2].im_func.__name__,
+          if limit is not None:
+            if limit != float("inf") and limit > self._now:
+              self._now = float(limit)
+            return []
+          # Nothing left to do until someone sleeps or schedules something
+          self._idle = True
+          self._clock.notifyAll()
+          self._wait()
+        elif self.paused and limit is None:
+          if heap and self._steps:
+            self._steps -= 1
+            if heap[0][0] > self._now:
+              self._now = heap[0][0]
+            return [heapq.heappop(heap)]
+          self._wait()
         else:
-          print o[2],
-        print o[3],o[4] if len(o[4]) else ''
-      o[2](*o[3],**o[4])
+          t = self.time()
+          if heap and heap[0][0] <= t:
+            break
+          wake = heap[0][0] if heap else float("inf")
+          if limit is not None:
+            if t >= limit or wake == limit == float("inf"):
+              return []
+            wake = min(wake, limit)
+          if wake == float("inf"):
+            self._wait()
+          else:
+            self._wait((wake - t) / self.speed)
+
+      if self.virtual:
+        t = heap[0][0]
+        if t > self._now:
+          self._now = t
+      batch = [heapq.heappop(heap)]
+      if not single:
+        while heap and heap[0][0] <= t:
+          batch.append(heapq.heappop(heap))
+      return batch
+
+  def depth (self):
+    """ Returns the number of pending events """
+    n = len(self._heap) + len(self._inbox) + len(self._prelist)
+    n += self._in_fifos
+    if self.spill is not None:
+      n += self.spill.count
+    return n
+
+  def pending_summary (self):
+    """
+    Returns a dict counting pending events by what they'll do, e.g.,
+    "Hub.handle_rx(Ping)" or "TimerWheel._wake".
+    """
+    with self._clock:
+      pending = [(o[2], o[3]) for o in self._heap]
+    pending += [(o[1], o[2]) for o in list(self._inbox)]
+    pending += [(o[1], o[2]) for o in self._prelist]
+    summary = {}
+    for method, args in pending:
+      label = describe_event(method, args)[1]
+      summary[label] = summary.get(label, 0) + 1
+    if self._in_fifos:
+      summary["(queued on cables)"] = self._in_fifos
+    if self.spill is not None and self.spill.count:
+      summary["(spilled to disk)"] = self.spill.count
+    return summary
+
+  def go_virtual (self):
+    """
+    Switches a real-time world to virtual time.
+    The clock carries on from where it is, but from now on it only
+    advances when someone calls sleep() (or run_until() and friends).
+    """
+    with self._clock:
+      if self.virtual: return
+      self._rebase()
+      self.virtual = True
+      self._horizon = self._now
+      self._clock.notifyAll()
+
+  def _run_batch (self, batch):
+    prev = getattr(_current, 'sim', None)
+    _current.sim = self.sim
+    try:
+      self._run_events(batch)
+    finally:
+      _current.sim = prev
+
+  def _run_events (self, batch):
+    lateness = None if self.virtual else self.lateness
+    for o in batch:
+      if lateness is not None:
+        lateness.record(self.time() - o[0])
+      if self.monitors:
+        self._monitored(o[2], o[3], o[4])
+      elif o[4]:
+        o[2](*o[3],**o[4])
+      else:
+        o[2](*o[3])
+    if lateness is not None:
+      lateness.tick()
+    now = self.time()
+    if now >= self._next_sample:
+      self._next_sample = now + self.depth_interval
+      self.depth_history.append((now, self.depth()))
+    self.guard.tick()
+    if self._quiet and self.quiescent():
+      quiet = self._quiet
+      self._quiet = []
+      for func in quiet:
+        func()
+
+  def call (self, method, args = (), kw = {}):
+    """ Calls method now, as if it were an event being dispatched """
+    if self.monitors:
+      self._monitored(method, args, kw)
+    else:
+      method(*args, **kw)
+
+  def _monitored (self, method, args, kw):
+    monitors = self.monitors
+    for m in monitors:
+      m.before(method, args)
+    start = _monotonic()
+    try:
+      method(*args, **kw)
+    finally:
+      elapsed = _monotonic() - start
+      for m in reversed(monitors):
+        m.after(method, args, elapsed)
+
+  def profile (self, path = None):
+    """
+    Starts timing every event handler (see sim/profiler.py).
+    The results are printed, and written to path in pstats format if it's
+    given, when the world thread stops or the program exits.  Returns the
+    Profiler, whose dump() can also be called at any time.
+    """
+    if self.profiler is None:
+      self.profiler = profiler.Profiler(self, path)
+      self.monitors.append(self.profiler)
+      atexit.register(self.profiler.dump)
+    elif path is not None:
+      self.profiler.path = path
+    return self.profiler
+
+  def trace (self, path, chunk = 10000):
+    """
+    Starts recording a timeline of the simulation to path, in the trace
+    event format Chrome and Perfetto load (see sim/tracer.py).  The file is
+    finished when the world thread stops or the program exits, or when
+    you call stop_trace().
+    """
+    self.stop_trace()
+    self.tracer = tracer.Tracer(self, path, chunk)
+    self.monitors.append(self.tracer)
+    atexit.register(self.tracer.close)
+    return self.tracer
+
+  def stop_trace (self):
+    """ Stops recording the timeline and finishes the file """
+    if self.tracer is None: return
+    self.monitors.remove(self.tracer)
+    self.tracer.close()
+    self.tracer = None
+
+  def journal (self, path, check = False):
+    """
+    Starts writing a line to path for every event that's dispatched, or if
+    check is True, checking that they're the same as those already in it
+    (see sim/replay.py).  Returns the Journal.
+    """
+    self.stop_journal()
+    self.journaler = replay.Journal(self, path, check)
+    self.monitors.append(self.journaler)
+    atexit.register(self.journaler.close)
+    return self.journaler
+
+  def stop_journal (self):
+    if self.journaler is None: return
+    self.monitors.remove(self.journaler)
+    self.journaler.close()
+    self.journaler = None
+
+  def _dispatch (self):
+    while not self._halted:
+      self._run_batch(self._next_batch())
+
+
+def describe_event (method, args):
+  """
+  Returns (entity, label) for a queued event: the Entity it concerns (or
+  None) and a short description like "Hub.handle_rx(Ping)".
+  """
+  import api
+  obj = getattr(method, 'im_self', None)
+  name = getattr(method, '__name__', None) or type(method).__name__
+  if obj is None:
+    return (None, name)
+  if name == '_deliver' and args:
+    # A packet on its way through a Cable
+    entity = obj.dstEnt
+    return (entity, "%s.handle_rx(%s)" % (type(entity).__name__,
+                                         type(args[0]).__name__))
+  if name == '_flush_rx' and args:
+    # A batch of packets for handle_rx_batch()
+    entity = args[0]
+    return (entity, "%s.handle_rx_batch" % (type(entity).__name__,))
+  if isinstance(obj, Timer) and obj.func is not None:
+    # Describe what the timer calls rather than the timer
+    entity, label = describe_event(obj.func, obj.args)
+    return (entity, label + " (timer)")
+  entity = obj if isinstance(obj, api.Entity) else None
+  return (entity, "%s.%s" % (type(obj).__name__, name))
 
 
 class TopoNode (object):
@@ -235,10 +953,38 @@ class TopoNode (object):
         o.append((self.entity.name,n,p.dstEnt.name,p.dstPort))
     return o
 
-  def __init__ (self, numPorts = 0, growPorts =  True):
+  def __init__ (self, numPorts = 0, growPorts =  True, sim = None):
     self.ports = [None] * numPorts
     self.growPorts = growPorts
     self.entity = None
+    self.sim = current() if sim is None else sim
+    # Indexes into ports, kept up to date by _setPort(), so that nothing
+    # has to look through all the ports
+    self._free = range(numPorts) # Heap of unused port numbers
+    self._neighbors = {} # TopoNode -> [port numbers]
+    self._active = () # Numbers of the ports in use (None if out of date)
+
+  def _setPort (self, index, cable):
+    """ Puts cable (or None) in port index """
+    old = self.ports[index]
+    if old is not None:
+      l = self._neighbors[old.dst]
+      l.remove(index)
+      if not l: del self._neighbors[old.dst]
+    self.ports[index] = cable
+    if cable is not None:
+      self._neighbors.setdefault(cable.dst, []).append(index)
+    elif old is not None:
+      heapq.heappush(self._free, index)
+    self._active = None
+
+  def activePorts (self):
+    """ Returns a tuple of the numbers of the ports that are connected """
+    a = self._active
+    if a is None:
+      a = self._active = tuple(i for i, p in enumerate(self.ports)
+                               if p is not None)
+    return a
 
   def linkTo (self, topoEntity, cable = None, fillEmpty = True, latency = None):
     """
@@ -277,20 +1023,21 @@ class TopoNode (object):
 
     topoEntity = topoOf(topoEntity)
     def getPort (entity):
-      if not fillEmpty or entity.ports.count(None) == 0:
+      if not fillEmpty or not entity._free:
         assert self.growPorts
         entity.ports.append(None)
         return len(entity.ports) - 1
-      return entity.ports.index(None)
+      return heapq.heappop(entity._free)
 
     assert topoEntity is not self
+    assert topoEntity.sim is self.sim, "Entities are in different simulations"
 
     remotePort = getPort(topoEntity)
     localPort = getPort(self)
 
     if cable[0] is not None:
       c = fixCableEnd(cable[0], self, localPort, topoEntity, remotePort)
-      self.ports[localPort] = c
+      self._setPort(localPort, c)
 
       #self.send(sim.basics.DiscoveryPacket(self.entity, True), localPort)
       
@@ -298,18 +1045,23 @@ class TopoNode (object):
       l = c.latency if isinstance(c, BasicCable) else None  # latency
       self.send(sim.basics.DiscoveryPacket(self.entity, latency=l), localPort)
 
+    else:
+      heapq.heappush(self._free, localPort)
+
     if cable[1] is not None:
       c = fixCableEnd(cable[1], topoEntity, remotePort, self, localPort)
-      topoEntity.ports[remotePort] = c
+      topoEntity._setPort(remotePort, c)
 
       #topoEntity.send(sim.basics.DiscoveryPacket(topoEntity.entity, True), remotePort)
 
       # Get latency if c is BasicCable - Kaifei Chen(kaifei@berkeley.edu)
       l = c.latency if isinstance(c, BasicCable) else None  # latency
       topoEntity.send(sim.basics.DiscoveryPacket(topoEntity.entity, latency=l), remotePort)
+    else:
+      heapq.heappush(topoEntity._free, remotePort)
 
-    world.doLater(.5, events.send_link_up, self.entity.name, localPort,
-             topoEntity.entity.name, remotePort)
+    self.sim.world.doLater(.5, self.sim.events.send_link_up, self.entity.name,
+                           localPort, topoEntity.entity.name, remotePort)
 
     return (localPort, remotePort)
 
@@ -320,7 +1072,7 @@ class TopoNode (object):
       if port is None: return
       other = port.dst
       otherPort = port.dstPort
-      events.send_link_down(self.entity.name, index, other.entity.name, otherPort)
+      self.sim.events.send_link_down(self.entity.name, index, other.entity.name, otherPort)
       
       #topoEntity.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, False), otherPort)
       #self.entity.handle_rx(sim.basics.DiscoveryPacket(topoEntity.entity, False), index)
@@ -329,25 +1081,19 @@ class TopoNode (object):
       topoEntity.entity.handle_rx(sim.basics.DiscoveryPacket(self.entity, latency=float("inf")), otherPort)
       self.entity.handle_rx(sim.basics.DiscoveryPacket(topoEntity.entity, latency=float("inf")), index)
 
-      other.ports[otherPort] = None
-      self.ports[index] = None
+      other._setPort(otherPort, None)
+      self._setPort(index, None)
 
-    remove = [index for index,value in enumerate(self.ports)
-              if value is not None and value.dst is topoEntity]
-    for index in remove:
-      world.doLater(0.5, goDown, index)
+    for index in sorted(self._neighbors.get(topoEntity, ())):
+      self.sim.world.doLater(0.5, goDown, index)
 
   def isConnectedTo (self, other):
-    other = topoOf(other)
-    for p in self.ports:
-      if p is None: continue
-      if p.dst is other:
-        return True
-    return False
+    return topoOf(other) in self._neighbors
 
   def disconnect (self):
-    for p in (port for port in self.ports if port):
-      self.unlinkTo(p.dst)
+    neighbors = self._neighbors
+    for other in sorted(neighbors, key = lambda n: min(neighbors[n])):
+      self.unlinkTo(other)
 
   def send (self, packet, port, flood = False):
     """
@@ -357,7 +1103,7 @@ class TopoNode (object):
     """
     packet.ttl -= 1
     if packet.ttl == 0:
-      simlog.warning("Expired %s / %s", packet, ','.join(e.name for e in packet.trace))
+      self.sim.world.guard.expire(packet)
       return
     if (packet.src is None) or (packet.src is NullAddress):
       packet.src = self.entity
@@ -370,103 +1116,338 @@ class TopoNode (object):
       ports = port
 
     if flood:
-      ports = [p for p in  range(0, len(self.ports)) if p not in ports]
-
+      if len(ports) == 1:
+        skip = ports[0]
+        ports = [p for p in self.activePorts() if p != skip]
+      else:
+        skip = set(ports)
+        ports = [p for p in self.activePorts() if p not in skip]
+
+    # Each port gets an envelope that shares the packet's body (see
+    # api.Packet), with its own ttl and trace
+    body = None
+    fresh = packet._body is None
+    sent = 0
+    put = object.__setattr__
     for remote in ports:
       if remote >=0 and remote < len(self.ports):
         remote = self.ports[remote]
         if remote is not None:
-          p = copy.copy(packet)
-          import basics
-          if isinstance(packet, basics.RoutingUpdate):
-            p.paths = copy.copy(packet.paths)
+          if body is None:
+            body, extra = packet._envelope()
+            cls = type(packet)
+            ttl = packet.ttl
+            trail = packet._trail
+          sent += 1
+          # (Packet.__setattr__ isn't needed for any of this)
+          p = object.__new__(cls)
+          put(p, '_body', body)
+          put(p, '_shared', True)
+          put(p, 'ttl', ttl)
+          put(p, '_trail', trail)
+          for k, v in extra:
+            put(p, k, v)
+          put(p, '_clean', not extra)
           remote.transfer(p)
+    if sent == 1 and fresh:
+      # The only envelope has the new body to itself (see sim/spill.py)
+      put(body, '_shared', False)
 
 
 def _getByName (name):
-  return topoOf(sys.modules['__builtin__'].__dict__.get(name, None))
+  return topoOf(current().get(name))
 
-topo = weakref.WeakValueDictionary()
 def CreateEntity (_name, _kind, *args, **kw):
   """
   Creates an Entity of kind, where kind is an Entity subclass.
   name is the name for the entity (e.g., "s1").
   Additional arguments are pased to the new Entity's __init__().
-  Returns the TopoNode containing the new Entity.
+  Returns the new Entity.
+  It's created in the current Simulation.
   """
-  if _name in sys.modules['__builtin__'].__dict__:
-    raise NameError(str(_name) + " already exists")
-  import api
-
-  e = _kind(*args, **kw)
-  setattr(e, 'name', _name)
-  numPorts = 0
-  growPorts = True
-  if hasattr(e, 'num_ports'):
-    ports = e.num_ports
-    growPorts = False
-
-  te = TopoNode(numPorts, growPorts)
-  te.entity = e
-
-  kind = "host" if isinstance(e, api.HostEntity) else "switch"
-  world.do(events.send_entity_up,e.name, kind)
-  simlog.info(e.name+" up!")
-
-  # Add working methods
-  setattr(e, 'get_port_count', lambda : len(te.ports))
-  def send (packet, port=None, flood=False):
-    te.send(packet, port, flood)
-  setattr(e, 'send', send)
-  def set_debug (*args):
-    #print e.name + ':', ' '.join((str(s) for s in args))
-    world.do(events.set_debug,e.name, ' '.join((str(s) for s in args)))
-  setattr(e, 'set_debug', set_debug)
-  def log (msg, *args, **kw):
-    level = "debug"
-    if "level" in kw:
-      level = kw["level"].lower()
-      del kw["level"]
-    if level not in ['debug', 'info', 'warning', 'error', 'critical', 'exception']:
-      level = "debug"
-    func = getattr(userlog, level)
-    msg = "%s:" + msg # Black magic
-    args = tuple([e.name] + list(args))
-    func(msg, *args, **kw)
-  setattr(e, 'log', log)
-
-  for m in ['linkTo', 'unlinkTo', 'disconnect']:
-    setattr(e, m, getattr(te, m))
-
-  def remove ():
-    te.disconnect()
-    world.do(events.send_entity_down,_name)
-    try:
-      del sys.modules['__builtin__'].__dict__[_name]
-    except:
-      pass
-  setattr(e, 'remove', remove)
-
-  # Make a global variable with the right name
-  #sys.modules['__main__'].__dict__[_name] = e
-  #sim.__dict__[_name] = e
-  sys.modules['__builtin__'].__dict__[_name] = e
-
-  # This is so we can find its TopoNode
-  topo[e] = te
-  return e
+  return current().create_entity(_name, _kind, *args, **kw)
 
 def topoOf (entity):
   """ Get TopoNode that contains entity.  Students never use this. """
   if type(entity) is TopoNode:
     # We were actually passed a topo object
     return entity
-  t = topo.get(entity, None)
+  t = getattr(entity, '_node', None)
+  if t is not None: return t
+  t = current().topo.get(entity, None)
+  if t is None:
+    for s in list(Simulation._all):
+      t = s.topo.get(entity, None)
+      if t is not None: break
   return t
 
-world = World()
-events = interface.interface()
 
-def simulate ():
-  """ Runs the simulator. """
-  world.start()
+class Simulation (object):
+  """
+  A simulation: a World, the entities in it, their topology and the
+  interface that tells the GUI about them.
+  There's a default one (whose World is core.world), and that's what the
+  module-level functions here use unless you're inside a
+  "with simulation:" block or an event the simulation is dispatching.
+  Other simulations are completely separate from it and each other, so
+  several of them can be set up and run in the same process:
+    s = Simulation()
+    with s:
+      h1 = BasicHost.create('h1')
+      ...
+    s.simulate(virtual=True, threaded=False)
+    s.run_until(30)
+  Only the default simulation talks to the GUI and puts the names of its
+  entities in __builtin__.
+  """
+  _all = weakref.WeakSet()
+
+  def __init__ (self, interface = None, virtual = False, register = False,
+                seed = None):
+    self.world = World(virtual)
+    self.world.sim = self
+    self.events = comm.NullInterface() if interface is None else interface
+    self.topo = weakref.WeakValueDictionary() # Entity -> TopoNode
+    self.entities = {} # Name -> Entity
+    self.register = register # Make the names of entities builtins?
+    self._prev = []
+    self._streams = {} # key -> random.Random
+    self.set_seed(seed)
+    Simulation._all.add(self)
+
+  def __enter__ (self):
+    """ Makes this the current simulation in this thread """
+    self._prev.append(getattr(_current, 'sim', None))
+    _current.sim = self
+    return self
+
+  def __exit__ (self, *exc):
+    _current.sim = self._prev.pop()
+
+  def get (self, name):
+    """ Returns the entity with the given name (or None) """
+    e = self.entities.get(name)
+    if e is None and self.register:
+      e = sys.modules['__builtin__'].__dict__.get(name, None)
+    return e
+
+  def create_entity (self, _name, _kind, *args, **kw):
+    """ Like CreateEntity(), but in this simulation """
+    if _name in self.entities or (self.register and
+        _name in sys.modules['__builtin__'].__dict__):
+      raise NameError(str(_name) + " already exists")
+    import api
+
+    world = self.world
+    events = self.events
+    prev = getattr(_current, 'sim', None)
+    _current.sim = self # Timers the entity creates are in this simulation
+    try:
+      e = _kind(*args, **kw)
+    finally:
+      _current.sim = prev
+    setattr(e, 'name', _name)
+    if not hasattr(e, 'random'): # Leave one the entity set itself alone
+      e.random = self.stream("entity", _name)
+    numPorts = 0
+    growPorts = True
+    if hasattr(e, 'num_ports'):
+      ports = e.num_ports
+      growPorts = False
+
+    te = TopoNode(numPorts, growPorts, sim = self)
+    te.entity = e
+    e._node = te
+
+    kind = "host" if isinstance(e, api.HostEntity) else "switch"
+    world.do(events.send_entity_up,e.name, kind)
+    simlog.info(e.name+" up!")
+
+    self.entities[_name] = e
+    if self.register:
+      # Make a global variable with the right name
+      #sys.modules['__main__'].__dict__[_name] = e
+      #sim.__dict__[_name] = e
+      sys.modules['__builtin__'].__dict__[_name] = e
+
+    # This is so we can find its TopoNode
+    self.topo[e] = te
+    return e
+
+  def remove_entity (self, e):
+    """ Takes entity e out of the simulation (see api.Entity.remove()) """
+    e._node.disconnect()
+    self.world.do(self.events.send_entity_down, e.name)
+    self.entities.pop(e.name, None)
+    if self.register:
+      try:
+        del sys.modules['__builtin__'].__dict__[e.name]
+      except:
+        pass
+
+  def set_seed (self, seed = None):
+    """
+    Sets the seed that all of this simulation's random numbers come from.
+    If it's None, one is picked at random.  Either way, it's logged when
+    the simulation starts, so that the run can be repeated.  Anything
+    drawn before the seed is set (e.g., while building the topology) was
+    drawn with the old one, so set it first.
+    """
+    if seed is None:
+      seed = random.SystemRandom().randrange(1 << 32)
+    self.seed = seed
+    for key, r in self._streams.iteritems():
+      r.seed(self._derive(key))
+
+  def stream (self, *key):
+    """
+    Returns the random.Random for key, e.g., ("cable", "s1", 2).
+    Each key gets a stream of its own, which depends only on the seed and
+    the key, so what's drawn from one doesn't change any other.
+    """
+    r = self._streams.get(key)
+    if r is None:
+      r = self._streams[key] = random.Random(self._derive(key))
+    return r
+
+  def _derive (self, key):
+    return int(hashlib.md5(repr((self.seed,) + key)).hexdigest(), 16)
+
+  def __getstate__ (self):
+    return {'world' : self.world, 'entities' : self.entities,
+            'topo' : dict(self.topo.items()), 'register' : self.register,
+            'seed' : self.seed, '_streams' : self._streams}
+
+  def __setstate__ (self, d):
+    # The interface is put back by checkpoint.restore()
+    self.world = d['world']
+    self.entities = d['entities']
+    self.topo = weakref.WeakValueDictionary(d['topo'])
+    self.register = d['register']
+    self.seed = d['seed']
+    self._streams = d['_streams']
+    self.events = None
+    self._prev = []
+    Simulation._all.add(self)
+
+  def simulate (self, virtual = None, threaded = True, profile = None,
+                trace = None):
+    """ Starts this simulation.  See core.simulate(). """
+    world = self.world
+    simlog.info("Random seed: %s", self.seed)
+    if profile:
+      world.profile(None if profile is True else profile)
+    if trace:
+      world.trace(trace)
+    if virtual is not None:
+      world.virtual = virtual
+    world.start(threaded = threaded)
+
+  def sleep (self, seconds):
+    self.world.sleep(seconds)
+
+  def run_until (self, t):
+    self.world.run_until(t)
+
+  def run_until_quiescent (self, max_time = None, timers = False):
+    return self.world.run_until_quiescent(max_time, timers)
+
+  def step (self, count = 1):
+    return self.world.step(count)
+
+  def spawn (self, gen):
+    """ Starts a script in this simulation.  See core.spawn(). """
+    import tasks
+    return tasks.Task(gen, self)
+
+  def run_script (self, gen, max_time = None):
+    """ Runs a script in this simulation.  See core.run_script(). """
+    task = self.spawn(gen)
+    self.world.run_until_done(task, max_time)
+    if task.error is not None:
+      raise task.error[0], task.error[1], task.error[2]
+    return task
+
+
+# The current Simulation for each thread, if it's not the default
+_current = threading.local()
+
+def current ():
+  """ Returns the current Simulation """
+  return getattr(_current, 'sim', None) or default
+
+# Set _DISABLE_INTERFACE in __main__ to keep the default simulation from
+# listening for the GUI (so that it doesn't tie up its port).
+if sys.modules['__main__'].__dict__.get("_DISABLE_INTERFACE", False):
+  default = Simulation(register = True)
+else:
+  default = Simulation(interface.interface(), register = True)
+world = default.world
+events = default.events
+topo = default.topo
+
+def simulate (virtual = None, threaded = True, profile = None, trace = None):
+  """
+  Runs the simulator.
+  If virtual is True, the simulator runs in virtual time: the clock jumps
+  from event to event, and only advances when you call sleep().
+  If threaded is False, the simulator doesn't run on its own at all.
+  Drive it with sleep(), run_until(), run_until_quiescent() or step().
+  If profile is True, every event handler is timed and a table of where
+  the time went is printed at the end; if it's a filename, the profile is
+  also written there in pstats format.
+  If trace is a filename, a timeline of the simulation is written there
+  for Chrome's about:tracing or Perfetto.
+  The random seed is logged, so that the run can be repeated with
+  set_seed().
+  """
+  current().simulate(virtual, threaded, profile, trace)
+
+def set_seed (seed = None):
+  """
+  Sets the seed that all random numbers (for entities, cables and
+  packets) come from.  Call it before creating any entities.  A run in
+  virtual time with threaded False does exactly the same thing every time
+  it's given the same seed.
+  """
+  current().set_seed(seed)
+
+def sleep (seconds):
+  """
+  Waits for the given number of simulated seconds.
+  Use this instead of time.sleep() so that scripts also work in virtual time.
+  """
+  current().sleep(seconds)
+
+def run_until (t):
+  """ Runs the simulator in this thread until simulated time t """
+  current().run_until(t)
+
+def run_until_quiescent (max_time = None, timers = False):
+  """
+  Runs the simulator in this thread until there's nothing left to do.
+  Returns False if it was still busy at simulated time max_time.
+  Pending timers are ignored unless timers is True.
+  """
+  return current().run_until_quiescent(max_time, timers)
+
+def step (count = 1):
+  """ Runs the next count events in this thread """
+  return current().step(count)
+
+def spawn (gen):
+  """
+  Starts running a script (see sim/tasks.py) as part of the simulation,
+  and returns its Task.
+  """
+  return current().spawn(gen)
+
+def run_script (gen, max_time = None):
+  """
+  Runs a script (see sim/tasks.py) until it finishes, and returns its
+  Task.  If the simulator has a thread of its own, this just waits;
+  otherwise, it runs the simulation in this thread (starting it if need
+  be), until simulated time max_time at the most.  If the script raises
+  an exception, so does this.
+  """
+  return current().run_script(gen, max_time)
@@ -0,0 +1,97 @@
+"""
+Keeps the packets on a cable out of the World's heap until they're next.
+Students should not need to use this.
+
+A BasicCable takes the same time to carry every packet, so they arrive in
+the order they were sent.  So rather than putting each packet in flight
+into the World's heap, a cable puts them in its Fifo, which only keeps the
+one(s) due first in the heap, and schedules the next when those arrive.
+The heap then holds about one event per busy cable rather than one per
+packet, however many of them there are.
+
+Each packet still gets the sequence number it would have had if it had
+gone straight into the heap, and all the packets due at the same time go
+in together, so in virtual time events run in exactly the same order
+either way (tests/fifo_order_test.py checks this).  In real time that
+only holds while the World keeps up.  When it falls behind, it takes
+everything that's overdue out of the heap at once, and that can include
+events due after a packet still waiting in a Fifo (which only goes in
+when the one ahead of it runs), so the packet runs after them.  Packets
+on the same cable still arrive in the order they were sent.
+
+When the World spills far-off events to disk (see sim/spill.py), a packet
+due after what it keeps in memory isn't held back in the Fifo.  It goes to
+the World (which spills it), and so does everything waiting ahead of it,
+so memory isn't used up by a long queue on a slow cable.  The Fifo then
+keeps packets back again once those have arrived.
+"""
+
+import thread
+import core
+import collections
+
+
+class Fifo (object):
+  def __init__ (self, world):
+    self.world = world
+    self.waiting = collections.deque() # Events that aren't in the heap yet
+    self.due = 0 # Events given to the World (all at the same time, unless
+                 # they were flush()ed)
+    self.last = None # The time of the last event posted
+
+  def __len__ (self):
+    return self.due + len(self.waiting)
+
+  def post (self, seconds, method, args):
+    """
+    Like World.post(), but method must call done() when it runs.
+    Returns False (and does nothing) if the event can't go in the Fifo:
+    if it's due before the last one (if the latency went down), or it's
+    not the thread running the World that's posting it.  Post it to the
+    World yourself then.
+    """
+    world = self.world
+    if not world._started or thread.get_ident() != world._owner:
+      return False
+    t = world.time() + seconds
+    if self.last is not None and t < self.last and len(self):
+      return False
+    record = (t, world._count, method, args, core._NOKW)
+    world._count += 1
+    if not self.due or (t == self.last and not self.waiting):
+      world._push(record)
+      self.due += 1
+    elif t >= world._spillAt:
+      # Far enough off to go to disk
+      self.flush()
+      world._push(record)
+      self.due += 1
+    else:
+      self.waiting.append(record)
+      world._in_fifos += 1
+    self.last = t
+    return True
+
+  def flush (self):
+    """
+    Gives the World all the events that are waiting (which then only
+    counts on their times and sequence numbers to keep them in order)
+    """
+    world = self.world
+    waiting = self.waiting
+    while waiting:
+      world._push(waiting.popleft())
+      world._in_fifos -= 1
+      self.due += 1
+
+  def done (self):
+    """ Called when one of the events in the heap runs """
+    self.due -= 1
+    waiting = self.waiting
+    if self.due or not waiting: return
+    world = self.world
+    t = waiting[0][0]
+    while waiting and waiting[0][0] == t:
+      world._push(waiting.popleft())
+      world._in_fifos -= 1
+      self.due += 1
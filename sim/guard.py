@@ -0,0 +1,90 @@
+"""
+Guards against broadcast storms.
+Students should not need to use this.
+
+A Hub on a topology with loops floods packets until their TTLs run out,
+and the number of packets in flight grows exponentially until then.  The
+StormGuard can drop packet deliveries before they're queued if:
+ max_depth  The World's queue already holds this many events
+ max_rate   The receiving entity has already had this many packets
+            delivered to it in the current (simulated) second
+Both are off (None) by default.
+
+Expired and dropped packets are also reported in aggregate, once per
+/interval/ simulated seconds, rather than with a log message apiece.  The
+first expired packet in each interval is still logged along with its
+trace.
+"""
+
+import logging
+
+simlog = logging.getLogger("simulator")
+
+
+class StormGuard (object):
+  def __init__ (self, world, max_depth = None, max_rate = None, interval = 5):
+    self.world = world
+    self.max_depth = max_depth
+    self.max_rate = max_rate
+    self.interval = interval
+
+    self.expired = 0 # Totals for the whole run
+    self.dropped = 0
+
+    self._rates = {} # entity -> [second, count]
+    self._expired = {} # packet type -> count (this interval)
+    self._dropped = {} # reason -> count (this interval)
+    self._report_at = None
+
+  def admit (self, entity, packet):
+    """ Returns False if a delivery of packet to entity should be dropped """
+    if self.max_depth is not None and self.world.depth() >= self.max_depth:
+      self._drop("queue depth")
+      return False
+    if self.max_rate is not None:
+      second = int(self.world.time())
+      r = self._rates.get(entity)
+      if r is None or r[0] != second:
+        self._rates[entity] = [second, 1]
+      elif r[1] >= self.max_rate:
+        self._drop("rate to " + str(entity.name))
+        return False
+      else:
+        r[1] += 1
+    return True
+
+  def _drop (self, reason):
+    self.dropped += 1
+    self._dropped[reason] = self._dropped.get(reason, 0) + 1
+    self._schedule_report()
+
+  def expire (self, packet):
+    """ Called when a packet's TTL runs out """
+    self.expired += 1
+    if not self._expired:
+      simlog.warning("Expired %s / %s", packet,
+                     ','.join(e.name for e in packet.trace))
+    kind = type(packet).__name__
+    self._expired[kind] = self._expired.get(kind, 0) + 1
+    self._schedule_report()
+
+  def _schedule_report (self):
+    if self._report_at is None:
+      self._report_at = self.world.time() + self.interval
+
+  def tick (self):
+    """ Called by the World now and then to report what's happened """
+    if self._report_at is None or self.world.time() < self._report_at:
+      return
+    self.report()
+
+  def report (self):
+    """ Logs what has expired and been dropped since the last report """
+    self._report_at = None
+    for what, counts in (("Expired", self._expired),
+                         ("Dropped", self._dropped)):
+      if not counts: continue
+      total = sum(counts.itervalues())
+      detail = ', '.join("%s: %i" % kv for kv in sorted(counts.iteritems()))
+      simlog.warning("%s %i packets (%s)", what, total, detail)
+      counts.clear()
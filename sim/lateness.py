@@ -0,0 +1,101 @@
+"""
+Keeps track of how late the real-time World dispatches events.
+Students should not need to use this.
+
+When handlers pile up, events run later than the time they were scheduled
+for, and link latencies and convergence times stop meaning much.  The
+World records the lateness of every event it dispatches here, and this
+reports a histogram of them through the simulator log every so often.
+
+If an event is later than /threshold/ seconds, the /policy/ decides what
+happens:
+ warn     Log a warning (at most once per reporting interval)
+ shed     Stop sending packet animations to the GUI until things catch up
+ virtual  Switch the World to virtual time, so the rest of the run keeps
+          correct simulated timings.  From then on, the clock only moves
+          when the script calls sleep() (or run_until() and friends).
+"""
+
+import bisect
+import logging
+import time
+
+simlog = logging.getLogger("simulator")
+
+
+class LatenessMonitor (object):
+  # Upper bounds (in seconds) of the histogram buckets.  There's one more
+  # bucket for everything later than the last one.
+  BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+  POLICIES = ('warn', 'shed', 'virtual')
+
+  def __init__ (self, world, threshold = 0.1, policy = 'warn', interval = 10):
+    assert policy in self.POLICIES
+    self.world = world
+    self.threshold = threshold
+    self.policy = policy
+    self.interval = interval # Real seconds between reports
+    self.reset()
+
+  def reset (self):
+    self.histogram = [0] * (len(self.BUCKETS) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.exceeded = 0 # Number of events later than threshold
+    self._next_report = time.time() + self.interval
+    self._recent_max = 0.0
+    self._warned = False
+
+  def record (self, lateness):
+    """ Records that an event ran /lateness/ seconds after its time """
+    if lateness < 0: lateness = 0.0
+    self.histogram[bisect.bisect_left(self.BUCKETS, lateness)] += 1
+    self.count += 1
+    self.total += lateness
+    if lateness > self.max: self.max = lateness
+    if lateness > self._recent_max: self._recent_max = lateness
+    if lateness > self.threshold:
+      self.exceeded += 1
+      self._too_late(lateness)
+
+  def _too_late (self, lateness):
+    if self.policy == 'warn':
+      if not self._warned:
+        self._warned = True
+        simlog.warning("Events are running up to %0.3fs late; timings may "
+                       "not be trustworthy", lateness)
+    elif self.policy == 'shed':
+      if not self.world.shedding:
+        self.world.shedding = True
+        simlog.warning("Events are running %0.3fs late; no longer sending "
+                       "packets to the GUI", lateness)
+    elif self.policy == 'virtual':
+      if not self.world.virtual:
+        simlog.warning("Events are running %0.3fs late; switching to "
+                       "virtual time", lateness)
+        self.world.go_virtual()
+
+  def tick (self):
+    """ Called by the World now and then to report and recover """
+    now = time.time()
+    if now < self._next_report: return
+    self._next_report = now + self.interval
+    if self.count:
+      level = logging.INFO if self._recent_max > self.threshold else logging.DEBUG
+      simlog.log(level, "Event lateness: %s", self)
+    if self.world.shedding and self._recent_max < self.threshold / 2:
+      self.world.shedding = False
+      simlog.info("Caught up; sending packets to the GUI again")
+    self._recent_max = 0.0
+    self._warned = False
+
+  def __str__ (self):
+    if not self.count: return "no events"
+    bounds = ["<%gms" % (b * 1000) for b in self.BUCKETS]
+    bounds.append(">=%gms" % (self.BUCKETS[-1] * 1000))
+    hist = ' '.join("%s:%i" % (b, n) for b, n in zip(bounds, self.histogram)
+                    if n)
+    return "%i events, mean %0.2fms, max %0.2fms, %i over %gms [%s]" % (
+        self.count, self.total / self.count * 1000, self.max * 1000,
+        self.exceeded, self.threshold * 1000, hist)
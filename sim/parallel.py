@@ -0,0 +1,345 @@
+"""
+Runs one simulation across several processes.
+Students should not need to use this.
+
+The topology is split into partitions, and each worker process runs one
+of them in a World of its own (in virtual time).  Every worker calls the
+same build() function in a fresh Simulation (with the entities' names
+as builtins, as usual, so scenarios work unchanged), so they all have the
+whole topology, and then each one throws away the events and timers of the
+entities it isn't running and cuts the cables leading out of its
+partition.  A packet put on a cut cable is sent to the worker running the
+other end, which delivers it over its own copy of the cable at the time
+it would have arrived anyway.
+
+The workers are kept in step conservatively.  Nothing can arrive over a
+cut cable sooner than the lowest latency of all the cut cables (the
+lookahead) after it was sent, so after each round of exchanging packets,
+every worker can safely run everything before the time of the earliest
+pending event anywhere plus the lookahead.  Rounds go like this:
+ 1. Every worker runs everything before the end of the round
+ 2. Every worker sends every other one the packets it has for it, the
+    time of its next event and the earliest arrival time of anything it
+    sent, so they all work out the same end for the next round
+Since cut cables need a lookahead, they must all be BasicCables with a
+latency greater than zero.
+
+Each entity gets the same packets at the same times as in a sequential
+run, but things that happen at exactly the same time can happen in a
+different order, so compare results as multisets at each time (as
+tests/parallel_test.py does).  In a sequential run, events at the same
+time run in the order they were scheduled.  Workers have no common order
+to go by, so a packet from another partition runs after any events at
+the same time that its receiver had already scheduled when it showed up.
+Packets from other partitions that arrive at the same time run in the
+order their senders scheduled them (in each sender's own World), then
+by sender and port.  That's the same from run to run, but anything that
+depends on the order of same-time events (such as which of two equally
+good routes a router picks) can turn out differently from a sequential
+run.
+
+It isn't free to split a simulation up.  Every worker calls build() and
+so pays for creating the whole topology, and events that aren't an
+entity's (scheduled lambdas, topology changes and the like) run in every
+worker, since they can change anything.  Only entities' own events and
+timers, and the packets they send, are divided up, so it's only worth it
+when those are most of the work.
+
+Usage:
+  def build ():
+    scenarios.candy.create(switch_type = DVRouter)
+  def collect (sim):
+    return dict((name, e.stats()) for name, e in sim.local.items())
+  results = parallel.run(build, until = 60, workers = 4, collect = collect)
+"""
+
+import sys
+import traceback
+import multiprocessing
+import cPickle as pickle
+import cStringIO as StringIO
+
+import core
+from cable import BasicCable
+
+
+def graph (sim):
+  """ Returns {name : set of neighbor names} for a Simulation """
+  g = {}
+  for te in sim.topo.values():
+    g.setdefault(te.entity.name, set())
+    for cable in te.ports:
+      if cable is None: continue
+      g[te.entity.name].add(cable.dstEnt.name)
+      g.setdefault(cable.dstEnt.name, set()).add(te.entity.name)
+  return g
+
+def _build (sim, build, keep = False):
+  """
+  Calls build() in sim with the names of its entities as builtins, as in
+  the default Simulation, since scenarios refer to entities that way.
+  The names of other simulations' entities are put aside meanwhile.
+  Unless keep is True, it's all put back as it was afterwards.
+  """
+  names = sys.modules['__builtin__'].__dict__
+  hidden = {}
+  for other in list(core.Simulation._all):
+    if other is not sim and other.register:
+      for n, e in other.entities.iteritems():
+        if names.get(n) is e:
+          hidden[n] = names.pop(n)
+  sim.register = True
+  try:
+    with sim:
+      build()
+  finally:
+    if not keep:
+      sim.register = False
+      for n, e in sim.entities.iteritems():
+        if names.get(n) is e:
+          del names[n]
+      names.update(hidden)
+
+def partition (sim, count):
+  """
+  Splits the entities of a Simulation into count partitions.
+  Returns {name : partition number}.  It goes through the graph breadth
+  first and cuts the order into equal parts, so that partitions tend to
+  be connected and not too many links are cut.
+  """
+  g = graph(sim)
+  order = []
+  seen = set()
+  for start in sorted(g):
+    if start in seen: continue
+    seen.add(start)
+    queue = [start]
+    while queue:
+      n = queue.pop(0)
+      order.append(n)
+      for m in sorted(g[n]):
+        if m not in seen:
+          seen.add(m)
+          queue.append(m)
+  size = -(-len(order) // count) if order else 1
+  return dict((n, i // size) for i, n in enumerate(order))
+
+
+class RemoteCable (BasicCable):
+  """ Stands in for a cable whose far end is in another partition """
+  def __init__ (self, cable, worker):
+    self.cable = cable
+    self.worker = worker
+    self.latency = cable.latency
+    self.initialize(cable.src, cable.srcPort, cable.dst, cable.dstPort)
+
+  def transfer (self, packet):
+    world = self.world
+    if not world.guard.admit(self.dstEnt, packet):
+      return
+    t = world.time() + self.latency
+    # Takes up the sequence number it would have had if it were posted
+    # here, which orders it among others arriving at the same time
+    seq = world._count
+    world._count += 1
+    self.worker.send(self, t, seq, packet)
+
+
+class DeadCable (BasicCable):
+  """ Stands in for the cables of entities this worker isn't running """
+  def __init__ (self, cable):
+    self.latency = getattr(cable, 'latency', 0)
+    self.initialize(cable.src, cable.srcPort, cable.dst, cable.dstPort)
+
+  def transfer (self, packet):
+    pass
+
+
+class Worker (object):
+  """ The part of a parallel run that happens in one process """
+  def __init__ (self, index, owner, inboxes, seed = None):
+    self.index = index
+    self.owner = owner # name -> worker index
+    self.inboxes = inboxes
+    self.peers = [i for i in range(len(inboxes)) if i != index]
+    self.sim = core.Simulation(virtual = True, seed = seed)
+    self._outbox = dict((i, []) for i in self.peers)
+    self._earliest = float("inf") # Earliest arrival of what we've sent
+    self._early = {} # round -> messages that came before we wanted them
+    self.sent = 0
+    self.received = 0
+    self.rounds = 0
+
+  def setup (self, build):
+    """ Builds the topology and cuts it down to this partition """
+    sim = self.sim
+    _build(sim, build, keep = True) # The worker has its own process
+    local = set(n for n, i in self.owner.iteritems() if i == self.index)
+    sim.local = dict((n, e) for n, e in sim.entities.iteritems()
+                     if n in local)
+    world = sim.world
+
+    def ours (method, args):
+      entity = core.describe_event(method, args)[0]
+      return entity is None or entity.name in local
+
+    world._prelist = [e for e in world._prelist if ours(e[1], e[2])]
+    for timer in world.timers.timers():
+      if not ours(timer.timeout, ()):
+        timer.cancel()
+
+    lookahead = float("inf")
+    self.incoming = {} # (src name, src port) -> cable
+    for te in sim.topo.values():
+      src = te.entity.name
+      for port, cable in enumerate(te.ports):
+        if cable is None: continue
+        dst = cable.dstEnt.name
+        if src not in local:
+          if dst in local:
+            self.incoming[(src, port)] = cable
+          te.ports[port] = DeadCable(cable)
+        elif dst not in local:
+          latency = getattr(cable, 'latency', None)
+          if type(cable) is not BasicCable or not latency > 0:
+            raise RuntimeError("Link from %s to %s can't be cut: it needs "
+                               "to be a BasicCable with a latency" % (src, dst))
+          lookahead = min(lookahead, latency)
+          te.ports[port] = RemoteCable(cable, self)
+    self.lookahead = lookahead
+
+  def send (self, cable, t, seq, packet):
+    """ Queues a packet for the worker running the far end of cable """
+    self._outbox[self.owner[cable.dstEnt.name]].append(
+        (t, seq, cable.srcEnt.name, cable.srcPort, packet))
+    self._earliest = min(self._earliest, t)
+    self.sent += 1
+
+  def _persistent_id (self, obj):
+    if obj is core.NullAddress: return 0
+    name = getattr(obj, 'name', None)
+    if name is not None and self.sim.entities.get(name) is obj:
+      return name
+    return None
+
+  def _persistent_load (self, pid):
+    if pid == 0: return core.NullAddress
+    return self.sim.entities[pid]
+
+  def _exchange (self):
+    """
+    Sends our packets to the other workers and gets theirs.
+    Returns the earliest time anything could happen anywhere next.
+    """
+    earliest = min(self.sim.world.next_time(), self._earliest)
+    for i in self.peers:
+      out = StringIO.StringIO()
+      p = pickle.Pickler(out, pickle.HIGHEST_PROTOCOL)
+      p.persistent_id = self._persistent_id
+      p.dump(self._outbox[i])
+      self.inboxes[i].put((self.rounds, earliest, out.getvalue()))
+      self._outbox[i] = []
+    self._earliest = float("inf")
+
+    messages = self._early.pop(self.rounds, [])
+    while len(messages) < len(self.peers):
+      r, t, data = self.inboxes[self.index].get()
+      if r == self.rounds:
+        messages.append((t, data))
+      else:
+        self._early.setdefault(r, []).append((t, data))
+
+    arrivals = []
+    for t, data in messages:
+      earliest = min(earliest, t)
+      u = pickle.Unpickler(StringIO.StringIO(data))
+      u.persistent_load = self._persistent_load
+      arrivals.extend(u.load())
+    arrivals.sort(key = lambda a: a[:4])
+    world = self.sim.world
+    for t, seq, src, port, packet in arrivals:
+      cable = self.incoming[(src, port)]
+      world.doAt(max(t, world.time()), cable._deliver, packet)
+    self.received += len(arrivals)
+    self.rounds += 1
+    return earliest
+
+  def run (self, until):
+    world = self.sim.world
+    self.sim.simulate(threaded = False)
+    while True:
+      earliest = self._exchange()
+      end = min(earliest + self.lookahead, until)
+      if earliest > until or end <= world.time():
+        break
+      world.run_until(end, exclusive = True)
+    world.run_until(until)
+
+
+def _work (index, owner, inboxes, results, build, until, collect, seed):
+  try:
+    w = Worker(index, owner, inboxes, seed)
+    w.setup(build)
+    w.run(until)
+    r = collect(w.sim) if collect is not None else None
+    results.put((index, True, (r, {'sent' : w.sent, 'received' : w.received,
+                                   'rounds' : w.rounds,
+                                   'entities' : len(w.sim.local)})))
+  except:
+    results.put((index, False, traceback.format_exc()))
+
+
+def run (build, until, workers = None, owner = None, collect = None,
+         seed = None):
+  """
+  Runs a simulation in parallel up to simulated time until.
+  build() should create the topology, just as a scenario's create() does.
+  owner can map each entity name to a worker number; by default, the
+  topology is split with partition().
+  collect(sim) is called in each worker at the end, with the worker's
+  Simulation (sim.local maps names to the entities it ran), and should
+  return something picklable.
+  All the workers use the same seed (by default, the current Simulation's)
+  so that entities and cables get the same random numbers as they would
+  in a sequential run.
+  Returns a list with what collect() returned in each worker, and
+  stores statistics about each worker in run.stats.
+  This forks, so it only works where multiprocessing can fork.
+  """
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if seed is None:
+    seed = core.current().seed
+  if owner is None:
+    s = core.Simulation()
+    _build(s, build)
+    owner = partition(s, workers)
+    del s
+  workers = max(owner.itervalues()) + 1 if owner else 1
+
+  inboxes = [multiprocessing.Queue() for _ in range(workers)]
+  results = multiprocessing.Queue()
+  procs = [multiprocessing.Process(target = _work,
+                                   args = (i, owner, inboxes, results, build,
+                                           until, collect, seed))
+           for i in range(workers)]
+  for p in procs:
+    p.daemon = True
+    p.start()
+
+  out = [None] * workers
+  stats = [None] * workers
+  error = None
+  for _ in range(workers):
+    index, ok, r = results.get()
+    if not ok:
+      error = "Worker %i failed:\n%s" % (index, r)
+      break
+    out[index], stats[index] = r
+  for p in procs:
+    if error is not None: p.terminate()
+    p.join()
+  if error is not None:
+    raise RuntimeError(error)
+  run.stats = stats
+  return out
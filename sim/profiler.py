@@ -0,0 +1,139 @@
+"""
+Times the event handlers the World dispatches.
+Students should not need to use this directly -- pass profile=True to
+sim.core.simulate(), or call sim.core.world.profile().
+
+Every dispatched event is timed and charged to the entity it concerns and
+what it was doing: for a packet delivery that's the receiving entity's
+handle_rx() and the type of the packet, for a timer it's the function the
+timer calls.  When the run ends, a table sorted by the time spent in each
+is printed, and if a path was given, the same numbers are written there in
+the format the pstats module reads, e.g.:
+  python -c "import pstats; pstats.Stats('sim.prof').sort_stats('tottime').print_stats(20)"
+
+Time spent in a handler doesn't include time spent in events it runs
+itself (such as the timers a wheel wakeup fires); that's in cumtime.
+"""
+
+import sys
+import marshal
+import inspect
+
+import core
+
+
+class HandlerStats (object):
+  def __init__ (self, entity, label):
+    self.entity = entity
+    self.label = label
+    self.calls = 0
+    self.tottime = 0.0
+    self.cumtime = 0.0
+
+  @property
+  def name (self):
+    if self.entity is None: return '-'
+    return str(self.entity.name)
+
+
+class Profiler (object):
+  def __init__ (self, world, path = None):
+    self.world = world
+    self.path = path
+    self.stats = {} # (entity, label) -> HandlerStats
+    self._code = {} # (entity, label) -> (filename, lineno, funcname)
+    self._stack = [] # Time spent in nested events, for each open event
+    self._dumped = None
+
+  def before (self, method, args):
+    self._stack.append(0.0)
+
+  def after (self, method, args, elapsed):
+    nested = self._stack.pop()
+    if self._stack:
+      self._stack[-1] += elapsed
+    key = core.describe_event(method, args)
+    s = self.stats.get(key)
+    if s is None:
+      s = self.stats[key] = HandlerStats(*key)
+      self._code[key] = _locate(method, key)
+    s.calls += 1
+    s.tottime += elapsed - nested
+    s.cumtime += elapsed
+
+  def reset (self):
+    self.stats.clear()
+    self._code.clear()
+    self._dumped = None
+
+  def sorted (self, key = 'tottime'):
+    """ Returns the HandlerStats, most expensive first """
+    return sorted(self.stats.itervalues(), key = lambda s: getattr(s, key),
+                  reverse = True)
+
+  def table (self, limit = None, key = 'tottime'):
+    """ Returns the stats as a table, sorted by key """
+    rows = self.sorted(key)
+    calls = sum(s.calls for s in rows)
+    total = sum(s.tottime for s in rows)
+    lines = ["%i events in %0.3f seconds" % (calls, total), "",
+             "%9s %10s %10s %10s  %-12s %s" % ("calls", "tottime", "percall",
+                                               "cumtime", "entity", "handler")]
+    for s in rows[:limit]:
+      lines.append("%9i %10.4f %10.6f %10.4f  %-12s %s" % (s.calls, s.tottime,
+                   s.tottime / s.calls, s.cumtime, s.name, s.label))
+    if limit is not None and len(rows) > limit:
+      lines.append("(%i more)" % (len(rows) - limit,))
+    return "\n".join(lines)
+
+  def pstats (self):
+    """ Returns the stats as a dictionary in the format pstats reads """
+    r = {}
+    for key, s in self.stats.iteritems():
+      r[self._code[key]] = (s.calls, s.calls, s.tottime, s.cumtime, {})
+    return r
+
+  def dump (self, path = None, out = None, limit = 40):
+    """
+    Prints the table and writes the pstats file (to path, or the path
+    given when profiling started, if any).
+    Does nothing if nothing has run since the last dump.
+    """
+    calls = sum(s.calls for s in self.stats.itervalues())
+    if not calls or calls == self._dumped: return
+    self._dumped = calls
+    if out is None: out = sys.stdout
+    print >>out, "Event handler profile:"
+    print >>out, self.table(limit)
+    if path is None: path = self.path
+    if path is not None:
+      f = open(path, 'wb')
+      try:
+        marshal.dump(self.pstats(), f)
+      finally:
+        f.close()
+      print >>out, "Profile written to", path
+    out.flush()
+
+
+def _locate (method, key):
+  """
+  Returns a (filename, lineno, funcname) for pstats.  The funcname is the
+  entity's name and the handler, so that each router gets its own line.
+  """
+  entity, label = key
+  func = method
+  if getattr(method, '__name__', None) == '_deliver' and entity is not None:
+    func = type(entity).handle_rx
+  elif isinstance(getattr(method, 'im_self', None), core.Timer):
+    func = method.im_self.func or method
+  func = getattr(func, 'im_func', func)
+  name = label if entity is None else "%s %s" % (entity.name, label)
+  code = getattr(func, 'func_code', None)
+  if code is None:
+    return ('~', 0, name)
+  try:
+    filename = inspect.getsourcefile(func) or code.co_filename
+  except TypeError:
+    filename = code.co_filename
+  return (filename, code.co_firstlineno, name)
@@ -0,0 +1,82 @@
+"""
+Keeps a journal of the events a simulation dispatches, to check that a run
+can be repeated exactly.
+Students should not need to use this directly -- call
+sim.core.world.journal(filename) to record a run, and
+sim.core.world.journal(filename, check = True) to check a later run
+against it.
+
+Each line of the journal is one event: its simulated time (exactly), the
+entity it concerns and what it was (for packets, which port they came in
+on and the packet).  A check stops the run with a Divergence at the first
+event that differs from the recording, which is usually right where
+whatever makes the runs differ comes in.  Either way, digest() is a hash
+of everything so far, for comparing runs without keeping the files.
+
+Random numbers come from the Simulation's seed (see Simulation.stream()),
+and events at the same time run in the order they were scheduled, so a
+simulation run with the same seed, in virtual time and without its own
+thread (simulate(virtual = True, threaded = False)), does the same thing
+every time.  In real time, or when other threads schedule things, when
+events happen depends on the wall clock, and the journal shows where.
+"""
+
+import hashlib
+
+import core
+
+
+class Divergence (RuntimeError):
+  """ A run did something different from the one it's checked against """
+  def __init__ (self, index, expected, got):
+    RuntimeError.__init__(self, "Event %i differs from the journal:\n"
+                          "  expected: %s\n  got:      %s"
+                          % (index, expected, got))
+    self.index = index
+    self.expected = expected
+    self.got = got
+
+
+def describe (world, method, args):
+  """ Returns the journal line for an event """
+  entity, label = core.describe_event(method, args)
+  line = "%r %s %s" % (world.time(), entity.name if entity else "-", label)
+  if getattr(method, '__name__', None) == '_deliver' and args:
+    line += " %s %r" % (method.im_self.dstPort, args[0])
+  return line
+
+
+class Journal (object):
+  def __init__ (self, world, path, check = False):
+    self.world = world
+    self.path = path
+    self.check = check
+    self.count = 0
+    self._hash = hashlib.md5()
+    self._file = open(path, 'r' if check else 'w')
+
+  def before (self, method, args):
+    line = describe(self.world, method, args)
+    self._hash.update(line)
+    self._hash.update("\n")
+    self.count += 1
+    if self._file is None: return
+    if not self.check:
+      self._file.write(line + "\n")
+      return
+    expected = self._file.readline()
+    if expected.rstrip("\n") != line:
+      self.close()
+      raise Divergence(self.count, expected.rstrip("\n") or "(the end)", line)
+
+  def after (self, method, args, elapsed):
+    pass
+
+  def digest (self):
+    """ Returns a hash of every event so far """
+    return self._hash.hexdigest()
+
+  def close (self):
+    if self._file is None: return
+    self._file.close()
+    self._file = None
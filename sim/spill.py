@@ -0,0 +1,260 @@
+"""
+Keeps far-future events on disk instead of in the World's heap.
+Students should not need to use this directly -- call
+sim.core.world.spill_to_disk() before a really big simulation.
+
+Simulated time is divided into buckets of /width/ seconds.  The World
+keeps events up to the end of the bucket it's working on in its heap, and
+hands anything later to the SpillQueue, which pickles it into the bucket
+for its time.  When the World gets to the end of what it has in memory, it
+loads the next bucket back.  The pickled events are buffered in memory,
+and once there are more than /buffer_size/ bytes of them, they're
+appended to a file per bucket.
+
+Only data that belongs to the event is pickled, along with immutable
+things like numbers, strings and tuples.  Everything else (entities,
+cables, timers, functions, and anything else the event merely refers to)
+is kept in memory, and the pickle just refers to it, so the events that
+come back behave exactly like the ones that went out.  What belongs to an
+event is marked explicitly: functions decorated with owns() (like a
+cable's _deliver()) own the packet that's their first argument, since
+nothing else can get at a packet while it's on a cable.  The packet owns
+its own attributes, and its body (see api.Packet) if send() marked that
+as belonging to it alone, which it does for a new packet sent out of a
+single port.  It also owns the lists, dicts and sets in them: once a
+packet has been sent, they mustn't be changed.  Other packets in it (like
+a Pong's original Ping) are kept in memory.
+
+Events are pickled by flush(), a little after they're scheduled.  One
+that can't be pickled just goes back into the heap.  Packets queued up
+behind others on a cable (see sim/fifo.py) are handed to the World once
+they're due after what it keeps in memory, so they get spilled too.
+Timers stay in memory, in the timing wheel, which only ever has one
+event in the heap.
+"""
+
+import os
+import types
+import atexit
+import shutil
+import tempfile
+import cPickle as pickle
+import cStringIO as StringIO
+
+import api
+
+
+# Things that are always pickled by value
+_VALUE_TYPES = frozenset([type(None), bool, int, long, float, complex, str,
+                          unicode, tuple, frozenset, type, types.ClassType,
+                          types.BuiltinFunctionType])
+
+# Things that are pickled by value if they belong to the event
+_MUTABLE_TYPES = frozenset([list, dict, set])
+
+# Functions whose events own their first argument (see owns())
+_owners = set()
+
+def owns (func):
+  """
+  Marks func as owning the packet that's the first argument of the events
+  that call it: nothing else refers to the packet until the event runs,
+  so spilling the event can take the packet with it.  Returns func (so
+  it can be used as a decorator).
+  """
+  _owners.add(func)
+  return func
+
+
+def _owned (record, owned):
+  """ Adds the ids of what belongs to record to owned """
+  method, args = record[2], record[3]
+  if not args or getattr(method, 'im_func', method) not in _owners: return
+  packet = args[0]
+  if not isinstance(packet, api.Packet): return
+  _owned_packet(packet, owned)
+  body = packet._body
+  if body is not None and not body._shared:
+    _owned_packet(body, owned)
+
+def _owned_packet (packet, owned):
+  owned.add(id(packet))
+  _owned_values((v for n, v in packet._state() if n != '_body'), owned)
+
+def _owned_values (values, owned):
+  for v in values:
+    t = type(v)
+    if t is tuple:
+      _owned_values(v, owned)
+    elif t in _MUTABLE_TYPES:
+      owned.add(id(v))
+      _owned_values(v.itervalues() if t is dict else v, owned)
+
+
+class Bucket (object):
+  """ The events for one span of simulated time """
+  def __init__ (self, index, path):
+    self.index = index
+    self.path = path
+    self.count = 0
+    self.size = 0 # Bytes written to the file so far
+    self.live = {} # id -> object the pickles refer to
+    self.owned = set() # ids of things to pickle by value in this record
+    self.buffer = StringIO.StringIO()
+    self.pickler = pickle.Pickler(self.buffer, pickle.HIGHEST_PROTOCOL)
+    self.pickler.persistent_id = self._persistent_id
+
+  def _persistent_id (self, obj):
+    t = type(obj)
+    if t in _VALUE_TYPES or id(obj) in self.owned:
+      return None
+    if t is types.MethodType:
+      # A new one is made every time a method is looked up, so rather than
+      # keeping each of them, keep what it's a method of and its name
+      of = obj.im_self if obj.im_self is not None else obj.im_class
+      self.live[id(of)] = of
+      return (id(of), obj.im_func.__name__)
+    self.live[id(obj)] = obj
+    return id(obj)
+
+  def _persistent_load (self, pid):
+    if type(pid) is tuple:
+      return getattr(self.live[pid[0]], pid[1])
+    return self.live[pid]
+
+  def add (self, record, owned):
+    """ Pickles record into the buffer; returns False if it can't be """
+    start = self.buffer.tell()
+    self.owned = owned
+    try:
+      self.pickler.dump(record)
+    except (pickle.PicklingError, TypeError, AttributeError):
+      self.buffer.seek(start)
+      self.buffer.truncate()
+      return False
+    finally:
+      self.pickler.clear_memo()
+      self.owned = set()
+    self.count += 1
+    return True
+
+  def buffered (self):
+    return self.buffer.tell()
+
+  def write (self):
+    """ Appends the buffer to the file """
+    data = self.buffer.getvalue()
+    if not data: return
+    f = open(self.path, 'ab')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    self.size += len(data)
+    self.buffer.seek(0)
+    self.buffer.truncate()
+
+  def load (self):
+    """ Returns the events in the bucket and deletes its file """
+    data = self.buffer.getvalue()
+    if self.size:
+      f = open(self.path, 'rb')
+      try:
+        data = f.read() + data
+      finally:
+        f.close()
+      os.remove(self.path)
+    unpickler = pickle.Unpickler(StringIO.StringIO(data))
+    unpickler.persistent_load = self._persistent_load
+    return [unpickler.load() for _ in xrange(self.count)]
+
+
+class SpillQueue (object):
+  def __init__ (self, directory = None, width = 10.0, buffer_size = 1 << 20):
+    self.width = float(width)
+    self.buffer_size = buffer_size
+    self._temporary = directory is None
+    if directory is None:
+      directory = tempfile.mkdtemp(prefix = "sim-spill-")
+    elif not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self._buckets = {} # index -> Bucket
+    self._pending = [] # Events to pickle on the next flush()
+    self.count = 0 # Events spilled and not loaded back yet
+    self.spilled = 0 # Totals for the whole run
+    self.loaded = 0
+    self.written = 0 # Bytes written to disk
+    atexit.register(self.close)
+
+  def boundary (self, t):
+    """ Returns the end of the bucket that time t is in """
+    return (int(t // self.width) + 1) * self.width
+
+  def push (self, record):
+    """ Spills a (time, count, method, args, kw) event """
+    self._pending.append(record)
+    self.count += 1
+
+  def flush (self):
+    """
+    Pickles the events pushed since the last flush, and returns those
+    that couldn't be pickled (which the caller should keep in memory).
+    """
+    failed = []
+    pending = self._pending
+    self._pending = []
+    while pending:
+      record = pending.pop()
+      owned = set()
+      _owned(record, owned)
+      index = int(record[0] // self.width)
+      bucket = self._buckets.get(index)
+      if bucket is None:
+        path = os.path.join(self.directory, "bucket-%i.pkl" % (index,))
+        bucket = self._buckets[index] = Bucket(index, path)
+      if bucket.add(record, owned):
+        self.spilled += 1
+        if bucket.buffered() > self.buffer_size:
+          self._write()
+      else:
+        self.count -= 1
+        failed.append(record)
+    return failed
+
+  def _write (self):
+    for bucket in self._buckets.itervalues():
+      n = bucket.buffered()
+      bucket.write()
+      self.written += n
+
+  def load (self):
+    """
+    Returns the events in the earliest bucket (in no particular order)
+    and the time at the end of that bucket.  Call flush() first.
+    """
+    index = min(self._buckets)
+    bucket = self._buckets.pop(index)
+    events = bucket.load()
+    self.count -= len(events)
+    self.loaded += len(events)
+    return events, (index + 1) * self.width
+
+  def stats (self):
+    return {'pending' : self.count, 'buckets' : len(self._buckets),
+            'spilled' : self.spilled, 'loaded' : self.loaded,
+            'written' : self.written}
+
+  def close (self):
+    """ Throws away anything still spilled """
+    for bucket in self._buckets.itervalues():
+      if bucket.size:
+        try:
+          os.remove(bucket.path)
+        except OSError:
+          pass
+    self._buckets.clear()
+    self._pending = []
+    self.count = 0
+    if self._temporary:
+      shutil.rmtree(self.directory, ignore_errors = True)
@@ -0,0 +1,172 @@
+"""
+Scripts that run as part of the simulation.
+
+A script is a generator function.  Whenever it needs to wait for
+something, it yields it, and it carries on when that has happened:
+  def script ():
+    yield tasks.sleep(5)                # Five simulated seconds
+    pong = yield h1a.ping_and_wait(h2b, timeout = 10)
+    if pong is None: print "No pong!"
+    topo.unlink(s1, s2)
+    yield tasks.quiescent()             # Until there's nothing left to do
+  sim.core.run_script(script())
+
+Scripts run in the World's own thread (or whichever thread is running it),
+as events like any other, so they never race with the simulation and
+nothing has to poll.  You can yield a Future (which is what sleep(),
+quiescent() and ping_and_wait() return), another Task (to wait for it to
+finish), a number (as with sleep()) or a list of any of those (to wait for
+all of them, getting a list of their values back).
+
+run_script() starts a script and waits for it; spawn() just starts it and
+returns its Task.  Scripts can't be checkpointed.
+"""
+
+import sys
+import threading
+import traceback
+
+import core
+
+
+# Guards Futures' done, _callbacks and _event, since a thread waiting for
+# one can look at them while the World's thread makes it happen
+_lock = threading.Lock()
+
+
+class Future (object):
+  """
+  Something that will happen.  Its value is set (once) with set(), or it
+  can fail() with an exception instead.
+  """
+  def __init__ (self):
+    self.done = False
+    self.value = None
+    self.error = None # sys.exc_info() if it failed
+    self._callbacks = []
+    self._event = None
+
+  def set (self, value = None):
+    """ Makes it happen; does nothing if it already has """
+    if self.done: return
+    self.value = value
+    self._finish()
+
+  def fail (self, exc_info = None):
+    """ Makes it fail with the exception (by default, the current one) """
+    if self.done: return
+    self.error = exc_info or sys.exc_info()
+    self._finish()
+
+  def _finish (self):
+    with _lock:
+      self.done = True
+      event = self._event
+      callbacks = self._callbacks
+      self._callbacks = []
+    if event is not None:
+      event.set()
+    for func in callbacks:
+      func(self)
+
+  def add_callback (self, func):
+    """ Calls func(self) when it happens (right away if it has) """
+    with _lock:
+      if not self.done:
+        self._callbacks.append(func)
+        return
+    func(self)
+
+  def wait (self, timeout = None):
+    """
+    Waits for it to happen from a thread that isn't running the
+    simulation.  Returns whether it has.
+    """
+    with _lock:
+      if self.done: return True
+      if self._event is None:
+        self._event = threading.Event()
+      event = self._event
+    event.wait(timeout)
+    return self.done
+
+
+class Task (Future):
+  """ A running script.  It happens when the generator finishes. """
+  def __init__ (self, gen, sim = None):
+    Future.__init__(self)
+    self.gen = gen
+    self.sim = core.current() if sim is None else sim
+    self.sim.world.doLater(0, self._step, None, None)
+
+  def __repr__ (self):
+    return "<Task %s>" % (getattr(self.gen, '__name__', self.gen),)
+
+  def _step (self, value, error):
+    try:
+      if error is not None:
+        w = self.gen.throw(*error)
+      else:
+        w = self.gen.send(value)
+    except StopIteration:
+      self.set()
+      return
+    except Exception:
+      core.simlog.error("%s failed:\n%s", self, traceback.format_exc())
+      self.fail()
+      return
+    try:
+      w = wrap(w)
+    except TypeError:
+      self.sim.world.doLater(0, self._step, None, sys.exc_info())
+      return
+    w.add_callback(self._wake)
+
+  def _wake (self, future):
+    self.sim.world.doLater(0, self._step, future.value, future.error)
+
+
+def wrap (w):
+  """ Returns a Future for something a script yielded """
+  if isinstance(w, Future):
+    return w
+  if isinstance(w, (int, long, float)):
+    return sleep(w)
+  if isinstance(w, (list, tuple)):
+    return all_of([wrap(x) for x in w])
+  raise TypeError("Scripts can't wait for " + repr(w))
+
+def sleep (seconds):
+  """ Returns a Future that happens after /seconds/ simulated seconds """
+  f = Future()
+  core.current().world.doLater(seconds, f.set)
+  return f
+
+def quiescent ():
+  """
+  Returns a Future that happens when nothing else is left to do (not
+  counting timers).
+  """
+  f = Future()
+  core.current().world.when_quiescent(f.set)
+  return f
+
+def all_of (futures):
+  """
+  Returns a Future that happens when all of the futures have, with a list
+  of their values.  It fails if any of them do.
+  """
+  f = Future()
+  left = [len(futures)]
+  def done (x):
+    if x.error is not None:
+      f.fail(x.error)
+      return
+    left[0] -= 1
+    if left[0] == 0:
+      f.set([x.value for x in futures])
+  if not futures:
+    f.set([])
+  for x in futures:
+    x.add_callback(done)
+  return f
@@ -24,9 +24,24 @@ def disconnect (entity):
   return topoOf(entity).disconnect()
 
 def show_ports (entity):
-  ports = topoOf(entity).get_ports()
+  """
+  Prints the entity's ports, and what's gone each way through the cables
+  that keep count (like cable.BandwidthCable).
+  """
+  te = topoOf(entity)
+  ports = te.get_ports()
   print "Ports for %s:" % (entity,)
   for p in ports:
     p1 = "%s:%i" % (p[0],p[1])
     p2 = "%s:%i" % (p[2],p[3])
     print "%14s <-> %-14s" % (p1,p2)
+    out = te.ports[p[1]]
+    back = topoOf(out.dstEnt).ports[p[3]]
+    for arrow, c in (("->", out), ("<-", back)):
+      if c is not None and hasattr(c, 'stats'):
+        print "%17s %s" % (arrow, _format_stats(c.stats()))
+
+def _format_stats (s):
+  return ("%(packets)i packets, %(bytes)i bytes, %(drops)i dropped, "
+          "%(queued)i queued (max %(max_queued)i), " % s
+          + "%.1f%% busy" % (s['utilization'] * 100,))
@@ -0,0 +1,129 @@
+"""
+Records a timeline of what the simulator does.
+Students should not need to use this directly -- pass trace=filename to
+sim.core.simulate(), or call sim.core.world.trace(filename).
+
+The timeline is written in the trace event format that Chrome's
+about:tracing and Perfetto (ui.perfetto.dev) load.  Each entity gets its
+own track, showing the packets it handles, the timers that fire for it
+and the packets it sends, with an arrow from each send to the matching
+handle_rx().  Events that don't concern an entity go on a "world" track.
+
+Timestamps are simulated time, so this works the same in real and
+virtual time.  Durations are the real time that a handler took (in
+virtual time, simulated time stands still while it runs).
+
+Events are kept in memory and written out /chunk/ at a time, and they're
+only formatted then, so recording costs little while the simulation runs.
+"""
+
+import json
+import time
+
+import core
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Tracer (object):
+  def __init__ (self, world, path, chunk = 10000):
+    self.world = world
+    self.path = path
+    self.chunk = chunk
+    self.recorded = 0
+    self._buffer = []
+    self._open = [] # (start time, wall clock) for each event being dispatched
+    self._tracks = {} # entity -> tid
+    self._flows = {} # id(packet) -> flow id, for packets on cables
+    self._nextFlow = 1
+    self._file = open(path, 'w')
+    self._file.write('[\n')
+    self._first = True
+    self._meta("process_name", 0, "simulator")
+    self._meta("thread_name", 0, "world")
+
+  def _meta (self, kind, tid, name):
+    self._buffer.append(('M', kind, tid, name))
+
+  def _track (self, entity):
+    if entity is None: return 0
+    tid = self._tracks.get(entity)
+    if tid is None:
+      tid = self._tracks[entity] = len(self._tracks) + 1
+      self._meta("thread_name", tid, str(entity.name))
+    return tid
+
+  def _add (self, record):
+    self._buffer.append(record)
+    self.recorded += 1
+    if len(self._buffer) >= self.chunk:
+      self.flush()
+
+  def before (self, method, args):
+    self._open.append((self.world.time(), _monotonic()))
+
+  def after (self, method, args, elapsed):
+    start, _ = self._open.pop()
+    entity, label = core.describe_event(method, args)
+    flow = None
+    if getattr(method, '__name__', None) == '_deliver' and args:
+      flow = self._flows.pop(id(args[0]), None)
+      kind = "rx"
+    elif isinstance(getattr(method, 'im_self', None), core.Timer):
+      kind = "timer"
+    else:
+      kind = "event"
+    self._add(('X', self._track(entity), start, elapsed, label, kind, flow))
+
+  def transfer (self, cable, packet, dropped = False):
+    """ Records a packet being put on a cable """
+    tid = self._track(cable.srcEnt)
+    flow = None
+    if not dropped:
+      flow = self._flows[id(packet)] = self._nextFlow
+      self._nextFlow += 1
+    self._add(('i', tid, self.world.time(), type(packet).__name__,
+               cable.dstEnt.name, flow))
+
+  def _format (self, r):
+    if r[0] == 'X':
+      _, tid, start, elapsed, label, kind, flow = r
+      e = {'ph':'X', 'pid':0, 'tid':tid, 'ts':start * 1e6, 'dur':elapsed * 1e6,
+           'name':label, 'cat':kind}
+      if flow is None: return [e]
+      return [e, {'ph':'f', 'bp':'e', 'pid':0, 'tid':tid, 'ts':start * 1e6,
+                  'id':flow, 'name':'packet', 'cat':'packet'}]
+    if r[0] == 'i':
+      _, tid, t, kind, dst, flow = r
+      e = {'ph':'i', 's':'t', 'pid':0, 'tid':tid, 'ts':t * 1e6,
+           'name':"send " + kind, 'cat':'tx', 'args':{'to':str(dst)}}
+      if flow is None:
+        e['name'] = "drop " + kind
+        return [e]
+      return [e, {'ph':'s', 'pid':0, 'tid':tid, 'ts':t * 1e6, 'id':flow,
+                  'name':'packet', 'cat':'packet'}]
+    _, kind, tid, name = r
+    return [{'ph':'M', 'pid':0, 'tid':tid, 'name':kind, 'args':{'name':name}}]
+
+  def flush (self):
+    """ Writes out everything recorded so far """
+    if self._file is None or not self._buffer: return
+    buf = self._buffer
+    self._buffer = []
+    out = []
+    for r in buf:
+      for e in self._format(r):
+        out.append(json.dumps(e, separators = (',',':')))
+    if not out: return
+    if not self._first: self._file.write(',\n')
+    self._first = False
+    self._file.write(',\n'.join(out))
+    self._file.flush()
+
+  def close (self):
+    """ Writes out what's left and finishes the file """
+    if self._file is None: return
+    self.flush()
+    self._file.write('\n]\n')
+    self._file.close()
+    self._file = None
@@ -0,0 +1,287 @@
+"""
+Tries out lots of changes to a simulation, each in a process of its own.
+Students should not need to use this.
+
+Get a simulation to where you want to start from (e.g., converged), and
+then give run() a list of perturbations.  For each one, a child process
+is forked from the current state (or restores a checkpoint), makes the
+change, runs in virtual time until things settle down, and reports back.
+Up to /workers/ of them run at once.
+
+A perturbation is a list of changes that are made together, each of which
+is ("unlink", a, b), ("link", a, b) or ("link", a, b, latency), where a
+and b are entity names.  single_failures() and double_failures() make
+lists of them for taking down every link, or every pair of links.
+
+"Settling down" normally means nothing is left to do but timers.  That
+never happens with a protocol that also sends updates from a timer, so give
+such trials settle (say, the update period): they then run, timers and
+all, until that long has gone by without a RoutingUpdate that says
+something different from the last one on the same cable (the first one
+on each cable after the change counts as different).
+
+Each result is a dict with:
+ perturbation  The perturbation
+ quiescent     Whether things settled down within max_time
+ reconvergence How long after the change the last RoutingUpdate arrived
+               (None if none did), or with settle, the last one that
+               said something new
+ updates       How many RoutingUpdates were delivered
+ holes         Pairs of hosts (src, dst) that are still connected but
+               whose pings didn't get through (if probe is True)
+ error         The traceback, if something went wrong (the rest is whatever
+               was worked out before then)
+"""
+
+import os
+import sys
+import select
+import itertools
+import traceback
+import multiprocessing
+import cPickle as pickle
+
+import api
+import core
+import topo
+import basics
+import checkpoint
+from parallel import graph
+
+
+def edges (sim = None, hosts = False):
+  """
+  Returns the links in a Simulation as sorted (a, b) name pairs.
+  Links to hosts are left out unless hosts is True.
+  """
+  if sim is None: sim = core.current()
+  r = set()
+  for te in sim.topo.values():
+    for cable in te.ports:
+      if cable is None: continue
+      a, b = te.entity, cable.dstEnt
+      if not hosts and (isinstance(a, api.HostEntity) or
+                        isinstance(b, api.HostEntity)):
+        continue
+      r.add(tuple(sorted((a.name, b.name))))
+  return sorted(r)
+
+def single_failures (links):
+  """ Returns a perturbation for taking down each of the links """
+  return [[("unlink", a, b)] for a, b in links]
+
+def double_failures (links):
+  """ Returns a perturbation for taking down each pair of the links """
+  return [[("unlink", a, b), ("unlink", c, d)]
+          for (a, b), (c, d) in itertools.combinations(links, 2)]
+
+
+class Observer (object):
+  """
+  A World monitor that watches deliveries of RoutingUpdates, and of Pings
+  to where they were going.
+  """
+  def __init__ (self):
+    self.updates = 0
+    self.last_update = None
+    self.last_news = None # The last update that differed from the one before
+    self.said = {} # cable -> the paths in the last update on it
+    self.reached = set()
+
+  def before (self, method, args):
+    pass
+
+  def after (self, method, args, elapsed):
+    if getattr(method, '__name__', None) != '_deliver' or not args: return
+    packet = args[0]
+    if isinstance(packet, basics.RoutingUpdate):
+      cable = method.im_self
+      self.updates += 1
+      self.last_update = cable.world.time()
+      if self.said.get(cable) != packet.paths:
+        self.said[cable] = dict(packet.paths)
+        self.last_news = self.last_update
+    elif type(packet) is basics.Ping and method.im_self.dstEnt is packet.dst:
+      self.reached.add((packet.src.name, packet.dst.name))
+
+
+def _connected (sim):
+  """ Returns the set of host name pairs with a path between them """
+  g = graph(sim)
+  hosts = sorted(n for n, e in sim.entities.iteritems()
+                 if isinstance(e, api.HostEntity))
+  pairs = set()
+  for h in hosts:
+    seen = set([h])
+    todo = [h]
+    while todo:
+      for m in g.get(todo.pop(), ()):
+        if m not in seen:
+          seen.add(m)
+          todo.append(m)
+    pairs.update((h, o) for o in hosts if o != h and o in seen)
+  return pairs
+
+
+def trial (sim, perturbation, max_time = 300, probe = True, probe_time = 60,
+           settle = None):
+  """
+  Makes the changes in perturbation to sim, runs it until it's quiet, and
+  returns a result (see above).  This changes sim, so run() does it in a
+  child process.
+  """
+  world = sim.world
+  if not world._started:
+    sim.simulate(virtual = True, threaded = False)
+  world.go_virtual() # Keeping the time it had got to
+  observer = Observer()
+  world.monitors.append(observer)
+
+  def entity (name):
+    return sim.entities[name]
+  edits = []
+  for change in perturbation:
+    if change[0] == "unlink":
+      edits.append((topo.unlink, entity(change[1]), entity(change[2])))
+    elif change[0] == "link":
+      edits.append((topo.link, entity(change[1]), entity(change[2]))
+                   + tuple(change[3:]))
+    else:
+      raise ValueError("Unknown change: " + repr(change))
+
+  r = {'perturbation' : perturbation}
+  try:
+    with sim:
+      start = world.time()
+      world.apply_at(start, edits)
+      if settle is None:
+        r['quiescent'] = world.run_until_quiescent(start + max_time)
+        last = observer.last_update
+      else:
+        r['quiescent'] = _settle(world, observer, start, settle, max_time)
+        last = observer.last_news
+      r['updates'] = observer.updates
+      r['reconvergence'] = None
+      if last is not None:
+        r['reconvergence'] = last - start
+
+      if probe:
+        hosts = sorted(n for n, e in sim.entities.iteritems()
+                       if isinstance(e, api.HostEntity))
+        for a in hosts:
+          for b in hosts:
+            if a != b:
+              world.doLater(0, entity(a).ping, entity(b))
+        world.run_until_quiescent(world.time() + probe_time)
+        r['holes'] = sorted(_connected(sim) - observer.reached)
+  except Exception:
+    r['error'] = traceback.format_exc()
+  finally:
+    world.monitors.remove(observer)
+  return r
+
+
+def _detach (sim):
+  """
+  Cuts a forked child off from the GUI (or whatever interface the parent
+  has), so that what the trial does doesn't show up there, and nothing
+  gets written to the parent's connection.
+  """
+  import comm
+  null = comm.NullInterface()
+  sim.events = null
+  core.default.events = null
+  core.events = null # Where log records and the console go
+  if isinstance(sys.stdout, core.stdout_wrapper):
+    sys.stdout = sys.__stdout__
+    sys.stderr = sys.__stderr__
+
+
+def _settle (world, observer, start, settle, max_time):
+  """
+  Runs until settle seconds go by with no news, or max_time after start.
+  Returns whether it got quiet.
+  """
+  while True:
+    quiet_since = start
+    if observer.last_news is not None:
+      quiet_since = max(quiet_since, observer.last_news)
+    if quiet_since + settle > start + max_time:
+      world.run_until(start + max_time)
+      return False
+    world.run_until(quiet_since + settle)
+    if observer.last_news is None or observer.last_news <= quiet_since:
+      return True
+
+
+def _child (sim, path, perturbation, kw, fd):
+  try:
+    try:
+      _detach(sim)
+      if path is not None:
+        sim = checkpoint.restore(path, as_default = False)
+      r = trial(sim, perturbation, **kw)
+    except:
+      r = {'perturbation' : perturbation, 'error' : traceback.format_exc()}
+    data = pickle.dumps(r, pickle.HIGHEST_PROTOCOL)
+    while data:
+      data = data[os.write(fd, data):]
+  finally:
+    os._exit(0)
+
+
+def run (perturbations, workers = None, path = None, sim = None, **kw):
+  """
+  Runs a trial() of each of the perturbations and returns their results
+  (in the same order).
+  Each child is forked from the current state of sim (by default, the
+  current Simulation), unless path is given, in which case it restores
+  the checkpoint there instead.  A Simulation running in its own thread
+  can't be forked, so it's checkpointed first.
+  Other keyword arguments are passed to trial().
+  """
+  if workers is None:
+    workers = multiprocessing.cpu_count()
+  if sim is None: sim = core.current()
+  temporary = None
+  if path is None and sim.world._thread is not None:
+    import tempfile
+    fd, temporary = tempfile.mkstemp(prefix = "sim-whatif-")
+    os.close(fd)
+    checkpoint.save(temporary, sim)
+    path = temporary
+  sys.stdout.flush()
+  sys.stderr.flush()
+
+  results = [None] * len(perturbations)
+  todo = list(enumerate(perturbations))
+  running = {} # read fd -> (index, pid, chunks)
+  try:
+    while todo or running:
+      while todo and len(running) < workers:
+        index, perturbation = todo.pop(0)
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+          os.close(rfd)
+          _child(sim, path, perturbation, kw, wfd)
+        os.close(wfd)
+        running[rfd] = (index, pid, [])
+      ready = select.select(list(running), [], [])[0]
+      for rfd in ready:
+        data = os.read(rfd, 1 << 16)
+        if data:
+          running[rfd][2].append(data)
+          continue
+        index, pid, chunks = running.pop(rfd)
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        try:
+          results[index] = pickle.loads(''.join(chunks))
+        except Exception:
+          results[index] = {'perturbation' : perturbations[index],
+                            'error' : "The child process died"}
+  finally:
+    if temporary is not None:
+      os.remove(temporary)
+  return results
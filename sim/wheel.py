@@ -0,0 +1,201 @@
+"""
+A hierarchical timing wheel for the simulator's timers.
+Students should not need to use this directly -- use api.create_timer().
+
+Time is divided into ticks of /resolution/ seconds.  Level 0 of the wheel
+has a slot for each of the next /slots/ ticks, level 1 has a slot for each
+of the next /slots/ groups of /slots/ ticks, and so on.  As the current
+tick crosses a group boundary, the matching slot of the level above is
+cascaded down into the finer level.  Adding and cancelling a timer are
+O(1), and a cancelled timer is really gone rather than left behind as a
+dead entry in the world's queue.
+
+Timers that are due in the same tick are coalesced: the wheel only ever
+has a single wakeup event in the World, and it fires all of them at once.
+"""
+
+import math
+
+
+class TimerWheel (object):
+  def __init__ (self, world, resolution = 0.01, slots = 256, levels = 4):
+    self.world = world
+    self.resolution = resolution
+    self.slots = slots
+    self.levels = levels
+    self._wheels = [[None] * slots for _ in range(levels)]
+    self._counts = [0] * levels
+    self._overflow = {}
+    self._tick = 0 # The next tick that hasn't been processed
+    self._pending = 0
+    self._seq = 0
+
+    # The wakeup we've scheduled in the world.  If an earlier one is needed,
+    # we schedule that too and bump the generation so the old one is ignored.
+    self._wakeTick = None
+    self._wakeGen = 0
+    self._firing = False
+    self.queued = 0 # Wakeups in the world's queue, including superseded ones
+
+    self.active = 0
+    self.cancelled = 0
+
+  def stats (self):
+    """ Returns counts of active and cancelled timers """
+    return {'active' : self.active, 'cancelled' : self.cancelled}
+
+  def timers (self):
+    """ Returns a list of the timers in the wheel """
+    r = []
+    for wheel in self._wheels:
+      for slot in wheel:
+        if slot: r.extend(slot.itervalues())
+    r.extend(self._overflow.itervalues())
+    return r
+
+  def add (self, timer, seconds):
+    """ Arranges for timer.timeout() to be called in /seconds/ seconds """
+    if self.world._foreign():
+      # Only the thread running the world touches the wheel
+      self.world.do(self.add, timer, seconds)
+      return
+    now = self.world.time() / self.resolution
+    if not self._pending:
+      # Nothing to catch up on, so skip straight to the present
+      self._tick = max(self._tick, int(math.floor(now + 1e-6)))
+    tick = max(int(math.ceil(now + seconds / self.resolution - 1e-6)),
+               self._tick)
+    timer._seq = self._seq
+    self._seq += 1
+    self._insert(timer, tick)
+    self.active += 1
+    self._pending += 1
+    if self._firing: return # _wake() reschedules when it's done
+    if self._wakeTick is None or tick < self._wakeTick:
+      self._schedule(tick)
+
+  def cancel (self, timer):
+    """ Removes a timer from the wheel """
+    if self.world._foreign():
+      self.world.do(self.cancel, timer)
+      return
+    slot = timer._slot
+    if slot is None: return
+    del slot[timer._seq]
+    timer._slot = None
+    if timer._level is not None:
+      self._counts[timer._level] -= 1
+    self.active -= 1
+    self.cancelled += 1
+    self._pending -= 1
+
+  def _insert (self, timer, tick):
+    timer._tick = tick
+    delta = tick - self._tick
+    span = 1
+    for level in range(self.levels):
+      if delta < span * self.slots:
+        wheel = self._wheels[level]
+        index = (tick // span) % self.slots
+        slot = wheel[index]
+        if slot is None:
+          slot = wheel[index] = {}
+        self._counts[level] += 1
+        break
+      span *= self.slots
+    else:
+      level = None
+      slot = self._overflow
+    slot[timer._seq] = timer
+    timer._slot = slot
+    timer._level = level
+
+  def _reinsert (self, slot):
+    for timer in slot.itervalues():
+      self._insert(timer, timer._tick)
+
+  def _cascade (self, tick):
+    """ Moves timers from coarser levels down as tick enters their group """
+    span = 1
+    for level in range(1, self.levels):
+      span *= self.slots
+      if tick % span: return
+      index = (tick // span) % self.slots
+      slot = self._wheels[level][index]
+      if slot:
+        self._wheels[level][index] = None
+        self._counts[level] -= len(slot)
+        self._reinsert(slot)
+    if tick % (span * self.slots) == 0 and self._overflow:
+      slot = self._overflow
+      self._overflow = {}
+      self._reinsert(slot)
+
+  def _next_tick (self):
+    """
+    Returns the next tick with something to do: either a level 0 slot
+    with timers in it or a group boundary where timers cascade down.
+    """
+    tick = self._tick
+    best = None
+    span = 1
+    for level in range(self.levels):
+      if self._counts[level]:
+        wheel = self._wheels[level]
+        # The first group that starts at or after the current tick
+        first = -(-tick // span)
+        for group in xrange(first, first + self.slots):
+          if wheel[group % self.slots]:
+            if best is None or group * span < best: best = group * span
+            break
+      span *= self.slots
+    if self._overflow:
+      t = -(-tick // span) * span
+      if best is None or t < best: best = t
+    return best
+
+  def _schedule (self, tick):
+    self._wakeTick = tick
+    self._wakeGen += 1
+    self.queued += 1
+    delay = max(0, tick * self.resolution - self.world.time())
+    self.world.doLater(delay, self._wake, self._wakeGen, tick)
+
+  def _wake (self, gen, tick):
+    self.queued -= 1
+    if gen != self._wakeGen: return # Superseded by an earlier wakeup
+    self._wakeTick = None
+    now = int(math.floor(self.world.time() / self.resolution + 1e-6))
+    self._firing = True
+    try:
+      self._advance(max(tick, now))
+    finally:
+      self._firing = False
+      if self._pending:
+        self._schedule(self._next_tick())
+
+  def _advance (self, until):
+    """ Fires everything due up to and including tick /until/ """
+    wheel = self._wheels[0]
+    while self._pending:
+      tick = self._next_tick()
+      if tick > until: break
+      self._tick = tick
+      self._cascade(tick)
+      self._tick = tick + 1
+      index = tick % self.slots
+      slot = wheel[index]
+      if not slot: continue
+      wheel[index] = None
+      self._counts[0] -= len(slot)
+      for timer in slot.itervalues():
+        timer._level = None # Already taken out of _counts
+      for seq in sorted(slot):
+        timer = slot.get(seq)
+        if timer is None: continue # Cancelled by an earlier one
+        timer._slot = None
+        self.active -= 1
+        self._pending -= 1
+        self.world.call(timer.timeout)
+    # Nothing is due in between, so we can skip ahead
+    self._tick = max(self._tick, until + 1)
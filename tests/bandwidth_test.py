@@ -0,0 +1,118 @@
+#!/bin/env python
+
+"""
+Checks cable.BandwidthCable: packets take wire_size() * 8 / bandwidth
+seconds each to send, one after another, and then the latency to arrive;
+they wait in a queue while the ones ahead of them are sent, and are
+dropped if it's full; and stats() counts what the cable has carried,
+what's queued and how busy it's been.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.basics
+import sim.core
+from sim.cable import BandwidthCable
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+BANDWIDTH = 8000 # 1000 bytes a second
+LATENCY = 1
+
+
+class Sized (api.Packet):
+  def __init__ (self, n, size):
+    api.Packet.__init__(self)
+    self.n = n
+    self.size = size
+
+  def wire_size (self):
+    return self.size
+
+
+class Source (api.Entity):
+  def burst (self, sizes):
+    for n, size in enumerate(sizes):
+      self.send(Sized(n, size), 0)
+
+
+class Sink (api.Entity):
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    if isinstance(packet, Sized):
+      self.got.append((sim.core.world.time(), packet.n))
+
+
+src = Source.create('src')
+dst = Sink.create('dst')
+cable, back = BandwidthCable.pair(latency = LATENCY, bandwidth = BANDWIDTH,
+                                  queue_size = 3)
+sim.core.topoOf(src).linkTo(dst, (cable, back))
+
+world = sim.core.world
+sim.core.simulate(virtual = True, threaded = False)
+sim.core.run_until(5)
+start = world.time()
+since = cable.since
+# Each way has carried the discovery packet so far
+before = cable.stats()
+busy = before['bytes'] * 8.0 / BANDWIDTH
+
+failed = []
+def expect (what, got, want):
+  if abs(got - want) > 1e-6:
+    failed.append("%s was %s, not %s" % (what, got, want))
+
+# Takes 0.5, 0.25, 1, 0.25 and 0.5 seconds to send: the first goes right
+# away, the next three wait, and the last is dropped
+world.doLater(0, src.burst, [500, 250, 1000, 250, 500])
+sim.core.run_until(start + 0.1)
+stats = cable.stats()
+expect("bytes", stats['bytes'], before['bytes'] + 2000)
+expect("packets", stats['packets'], before['packets'] + 4)
+expect("drops", stats['drops'], 1)
+expect("queued", stats['queued'], 3)
+expect("max_queued", stats['max_queued'], 3)
+expect("utilization", stats['utilization'], (busy + 0.1) / (start + 0.1 - since))
+
+# The second and third have started by now
+sim.core.run_until(start + 1)
+expect("queued later", cable.queued(), 1)
+expect("utilization later", cable.utilization(), (busy + 1) / (start + 1 - since))
+
+sim.core.run_until(start + 10)
+stats = cable.stats()
+expect("queued at the end", stats['queued'], 0)
+expect("utilization at the end", stats['utilization'],
+       (busy + 2) / (start + 10 - since))
+if back.stats()['packets'] != before['packets']:
+  failed.append("Packets went the other way: %s" % (back.stats(),))
+
+want = [(0.5, 0), (0.75, 1), (1.75, 2), (2.0, 3)]
+got = [(t - start - LATENCY, n) for t, n in dst.got]
+if len(got) != len(want):
+  failed.append("Got %s" % (got,))
+for (t, n), (wt, wn) in zip(got, want):
+  if n != wn or abs(t - wt) > 1e-6:
+    failed.append("Packet %i was sent at %s, not packet %i at %s"
+                  % (n, t, wn, wt))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("The cable misbehaved!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
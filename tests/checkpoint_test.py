@@ -0,0 +1,121 @@
+#!/bin/env python
+
+"""
+Checks that a checkpointed simulation carries on exactly as the original
+does: packets in flight, timers, and scheduled lambdas and closures
+(including one that refers to itself and one with a cell that was never
+set) all happen at the same times after restore() as they would have.
+Also checks that restoring over a default World that's running in its own
+thread stops that thread.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+import tempfile
+
+import sim.api as api
+import sim.basics as basics
+import sim.core
+import sim.topo as topo
+import sim.checkpoint as checkpoint
+from hub import Hub
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+class Host (basics.BasicHost):
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    self.got.append((sim.core.world.time(), type(packet).__name__, port,
+                     packet.src.name, packet.ttl,
+                     [e.name for e in packet.trace]))
+    basics.BasicHost.handle_rx(self, packet, port)
+
+
+def countdown (host, n):
+  """ A closure that refers to itself, pinging every second n times """
+  def again ():
+    host.ping(h0)
+    left[0] -= 1
+    if left[0]: sim.core.world.doLater(1, again)
+  left = [n]
+  sim.core.world.doLater(1, again)
+
+def unset (host):
+  """ A closure with a cell that's never set """
+  def f ():
+    host.got.append(('unset', sim.core.world.time()))
+    if False: return later
+  if False: later = None
+  return f
+
+
+N = 6
+hosts = [Host.create('h%i' % (i,)) for i in range(N)]
+hubs = [Hub.create('r%i' % (i,)) for i in range(N)]
+for i in range(N):
+  topo.link(hosts[i], hubs[i], latency = 0.1)
+  topo.link(hubs[i], hubs[(i + 1) % N], latency = 0.5 + 0.25 * (i % 3))
+for i in range(N):
+  sim.core.world.doLater(2 + 0.3 * i, hosts[i].ping, hosts[(i + N // 2) % N])
+  api.create_timer(0.7, lambda i=i: hosts[i].got.append(
+      ('tick', sim.core.world.time())))
+  countdown(hosts[i], 5)
+  sim.core.world.doLater(3 + 0.1 * i, unset(hosts[i]))
+
+fd, path = tempfile.mkstemp(prefix = "checkpoint-test-")
+os.close(fd)
+
+failed = []
+try:
+  sim.core.simulate(virtual = True)
+  sim.core.sleep(2.3)
+  checkpoint.save(path)
+  sim.core.sleep(10 - 2.3)
+  before = dict((h.name, list(h.got)) for h in hosts)
+  old = sim.core.world
+
+  s = checkpoint.restore(path)
+  if old._thread.is_alive():
+    failed.append("The old World's thread is still running")
+  if sim.core.world is not s.world:
+    failed.append("The restored World isn't the default")
+  if abs(s.world.time() - 2.3) > 1e-9:
+    failed.append("The restored World is at %s" % (s.world.time(),))
+
+  # Everything in the checkpoint refers to the new entities
+  hosts = [s.entities['h%i' % (i,)] for i in range(N)]
+  sim.core.simulate(virtual = True, threaded = False)
+  sim.core.run_until(10)
+  after = dict((h.name, list(h.got)) for h in hosts)
+
+  if sum(len(v) for v in before.values()) < 300:
+    failed.append("Not much happened")
+  for name in sorted(before):
+    if before[name] != after[name]:
+      failed.append("%s got %s originally but %s after restoring"
+                    % (name, before[name][-3:], after[name][-3:]))
+except Exception:
+  import traceback
+  traceback.print_exc()
+  failed.append("Exception")
+finally:
+  os.remove(path)
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Checkpoint didn't round-trip!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
@@ -0,0 +1,98 @@
+#!/bin/env python
+
+"""
+Checks that the copies of a packet that send() makes (envelopes sharing
+one body) behave like separate packets: each has its own ttl and trace,
+setting an attribute on one doesn't change the others, add_destination()
+on a RoutingUpdate that's been sent or received copies its paths first,
+and changing a packet after sending it doesn't change the copies that
+are on their way.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.core
+import sim.topo as topo
+from sim.basics import RoutingUpdate
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+class Sender (api.Entity):
+  def go (self):
+    ru = RoutingUpdate()
+    ru.add_destination('a', 1)
+    self.send(ru, flood = True)
+    # Neither of these should change what's already been sent
+    ru.add_destination('b', 2)
+    ru.note = 'changed'
+    self.sent = ru
+
+
+class Receiver (api.Entity):
+  """ Records what it gets, then scribbles on it """
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    if type(packet) is not RoutingUpdate: return
+    self.got.append((dict(packet.paths), [e.name for e in packet.trace],
+                     packet.ttl, getattr(packet, 'note', None)))
+    packet.add_destination(self.name, 1)
+    packet.note = self.name
+    packet.ttl = 1
+
+
+class Forwarder (Receiver):
+  """ Records what it gets, and floods it on """
+  def handle_rx (self, packet, port):
+    if type(packet) is not RoutingUpdate: return
+    Receiver.handle_rx(self, packet, port)
+    packet.ttl = 10
+    self.send(packet, port, flood = True)
+
+
+s = Sender.create('s')
+receivers = [Receiver.create('r%i' % (i,)) for i in range(3)]
+f = Forwarder.create('f')
+sinks = [Receiver.create('x%i' % (i,)) for i in range(2)]
+for r in receivers + [f]:
+  topo.link(s, r)
+for x in sinks:
+  topo.link(f, x)
+
+sim.core.simulate(virtual = True, threaded = False)
+sim.core.world.doLater(2, s.go)
+sim.core.run_until_quiescent()
+
+failed = []
+def expect (entity, got):
+  if entity.got != got:
+    failed.append("%s got %s, not %s" % (entity.name, entity.got, got))
+
+for r in receivers:
+  expect(r, [({'a' : 1}, [r.name], 19, None)])
+expect(f, [({'a' : 1}, ['f'], 19, None)])
+# f's changes to its copy (but not the other receivers') went with it
+for x in sinks:
+  expect(x, [({'a' : 1, 'f' : 1}, ['f', x.name], 9, 'f')])
+if s.sent.paths != {'a' : 1, 'b' : 2} or s.sent.note != 'changed':
+  failed.append("The sender's packet is now %s" % (s.sent.paths,))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Copies of packets weren't separate!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
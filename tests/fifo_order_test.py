@@ -0,0 +1,111 @@
+#!/bin/env python
+
+"""
+Checks that keeping packets in flight in cables' Fifos (see sim/fifo.py)
+doesn't change the order things happen in, in virtual time: lots of
+packets arriving at the same time over different cables, bursts sent at
+the same time down one cable, and other events due at the same time as
+deliveries all run in the order they do when every packet goes straight
+into the World's heap.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.basics
+import sim.core
+import sim.fifo
+import sim.topo as topo
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+class Numbered (api.Packet):
+  def __init__ (self, n):
+    api.Packet.__init__(self)
+    self.n = n
+
+
+class Source (api.Entity):
+  def __init__ (self, burst):
+    self.burst = burst
+    self.sent = 0
+
+  def tick (self):
+    for i in range(self.burst):
+      self.sent += 1
+      self.send(Numbered(self.sent), flood = True)
+
+
+class Sink (api.Entity):
+  def handle_rx (self, packet, port):
+    if isinstance(packet, Numbered):
+      log.append((sim.core.current().world.time(), self.name,
+                  packet.src.name, packet.n, port))
+
+
+def mark (n):
+  log.append((sim.core.current().world.time(), 'event', n))
+
+
+def run (fifos):
+  """ Builds the network in a Simulation of its own and runs it """
+  s = sim.core.Simulation()
+  with s:
+    hub = Sink.create('hub')
+    sinks = [Sink.create('k%i' % (i,)) for i in range(3)]
+    sources = [Source.create('s%i' % (i,), i + 1) for i in range(4)]
+    for src in sources:
+      for k in sinks + [hub]:
+        topo.link(src, k, latency = 1)
+    for t in range(20):
+      for src in sources:
+        s.world.doLater(t * 0.5, src.tick)
+      # Lands at the same time as the deliveries from two ticks earlier
+      s.world.doLater(t * 0.5 + 1, mark, t)
+  s.simulate(virtual = True, threaded = False)
+  post = sim.fifo.Fifo.post
+  if not fifos:
+    sim.fifo.Fifo.post = lambda self, seconds, method, args: False
+  try:
+    s.run_until(30)
+  finally:
+    sim.fifo.Fifo.post = post
+
+
+failed = []
+
+log = []
+run(fifos = True)
+with_fifos = log
+
+log = []
+run(fifos = False)
+without_fifos = log
+
+if len(with_fifos) != 20 * 10 * 4 + 20:
+  failed.append("Expected %i things to happen but %i did"
+                % (20 * 10 * 4 + 20, len(with_fifos)))
+for i, (a, b) in enumerate(zip(with_fifos, without_fifos)):
+  if a != b:
+    failed.append("Thing %i was %s with Fifos but %s without" % (i, a, b))
+if len(with_fifos) != len(without_fifos):
+  failed.append("%i things happened with Fifos but %i without"
+                % (len(with_fifos), len(without_fifos)))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Order changed!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
@@ -0,0 +1,106 @@
+#!/bin/env python
+
+"""
+Checks what packets keep for themselves now that they use slots: you can
+still give a packet attributes of your own (and they go with it), colours
+are worked out when they're first read and stay the same from then on
+(including on the copies that arrive), a Pong's colours are its Ping's
+the other way round, and the trace reads and assigns as a list, with the
+copies from a flood sharing the part from before they split.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.core
+import sim.topo as topo
+from sim.basics import Ping, Pong
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+class Keeper (api.Entity):
+  """ Keeps what it gets, and floods it on if forward is True """
+  def __init__ (self, forward = False):
+    self.forward = forward
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    if type(packet) is not Ping: return
+    self.got.append(packet)
+    if self.forward:
+      self.send(packet, port, flood = True)
+
+
+failed = []
+
+# Colours
+p = Ping(None)
+if p._outer is not None or p._inner is not None:
+  failed.append("A new Ping already has its colours")
+outer = p.outer_color
+if len(outer) != 4 or outer[3] != Ping._ALPHA or p.outer_color is not outer:
+  failed.append("A Ping's outer colour is %s" % (outer,))
+p.inner_color = [1, 0, 0, 1]
+pong = Pong(p)
+if pong.outer_color != [1, 0, 0, 1] or pong.inner_color != outer:
+  failed.append("A Pong's colours are %s and %s"
+                % (pong.outer_color, pong.inner_color))
+
+# Attributes of your own
+p.mine = 'yes'
+if p.mine != 'yes':
+  failed.append("Couldn't give a Ping an attribute")
+
+# Traces
+a, b = Keeper.create('a'), Keeper.create('b')
+p.trace = [a, b]
+trace = p.trace
+trace.append(p)
+if p.trace != [a, b]:
+  failed.append("The trace is %s" % (p.trace,))
+
+s = Keeper.create('s')
+f = Keeper.create('f', forward = True)
+xs = [Keeper.create('x%i' % (i,)) for i in range(2)]
+topo.link(s, f)
+for x in xs:
+  topo.link(f, x)
+sim.core.simulate(virtual = True, threaded = False)
+sent = Ping(None)
+sent.mine = 'yes'
+color = sent.outer_color
+sim.core.world.doLater(2, s.send, sent, 0)
+sim.core.run_until_quiescent()
+
+got = [x.got[0] if len(x.got) == 1 else None for x in xs]
+if None in got:
+  failed.append("The sinks got %s" % ([x.got for x in xs],))
+else:
+  for x, q in zip(xs, got):
+    if q.trace != [f, x]:
+      failed.append("%s's copy has trace %s" % (x.name, q.trace))
+    if q.mine != 'yes':
+      failed.append("%s's copy lost its attribute" % (x.name,))
+    if q.outer_color != color:
+      failed.append("%s's copy is %s, not %s"
+                    % (x.name, q.outer_color, color))
+  if got[0]._trail[1] is not got[1]._trail[1]:
+    failed.append("The copies don't share the start of their traces")
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Packets misbehaved!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
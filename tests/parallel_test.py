@@ -0,0 +1,96 @@
+#!/bin/env python
+
+"""
+Checks that a parallel run (see sim/parallel.py) delivers the same
+packets at the same times as a sequential run of the same network.  The
+ring's links all have the same latency, so lots of packets reach hubs
+from both directions at once, some of them across the cut between the
+workers.  Things at the same time can happen in a different order in a
+parallel run, so what each host got is compared as a multiset.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.basics as basics
+import sim.core
+import sim.topo as topo
+import sim.parallel as parallel
+from hub import Hub
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+N = 12
+
+
+class Host (basics.BasicHost):
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    self.got.append((sim.core.current().world.time(), type(packet).__name__,
+                     port, packet.src.name, packet.ttl))
+    basics.BasicHost.handle_rx(self, packet, port)
+
+
+def build ():
+  world = sim.core.current().world
+  hosts = [Host.create('h%i' % (i,)) for i in range(N)]
+  hubs = [Hub.create('r%i' % (i,)) for i in range(N)]
+  for i in range(N):
+    topo.link(hosts[i], hubs[i], latency = 0.25)
+    topo.link(hubs[i], hubs[(i + 1) % N], latency = 0.5)
+  for i in range(N):
+    for k in range(4):
+      world.doLater(1 + 3 * k, hosts[i].ping, hosts[(i + N // 2) % N])
+
+def collect (sim):
+  return dict((n, sorted(e.got)) for n, e in sim.local.iteritems()
+              if isinstance(e, Host))
+
+
+failed = []
+
+s = sim.core.Simulation()
+with s:
+  build()
+s.simulate(virtual = True, threaded = False)
+s.run_until(30)
+sequential = dict((n, sorted(e.got)) for n, e in s.entities.iteritems()
+                  if isinstance(e, Host))
+
+together = {}
+try:
+  for r in parallel.run(build, 30, workers = 3, collect = collect):
+    together.update(r)
+except Exception:
+  import traceback
+  traceback.print_exc()
+  failed.append("The parallel run failed")
+
+if sum(len(v) for v in sequential.values()) < 1000:
+  failed.append("Not much happened")
+if not failed and not all(st['received'] for st in parallel.run.stats):
+  failed.append("Nothing crossed between the workers")
+for name in sorted(sequential):
+  if sequential[name] != together.get(name):
+    failed.append("%s got %i packets in sequence but %i in parallel"
+                  % (name, len(sequential[name]),
+                     len(together.get(name, ()))))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Parallel and sequential runs differ!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
@@ -63,8 +63,8 @@ _DISABLE_CONSOLE_LOG = True
 
 create(switch)
 start = sim.core.simulate
-start()
-time.sleep(10)
+start(virtual=True, threaded=False)
+sim.core.run_until(10)
 if(failed):
   print("You have failed since I got unexpected updates!")
   os._exit(0)
@@ -131,20 +131,20 @@ _DISABLE_CONSOLE_LOG = True
 
 create(switch)
 start = sim.core.simulate
-start()
-time.sleep(30)
+start(virtual=True)
+sim.core.sleep(30)
 topo.unlink(s1, h1b)
 topo.unlink(s7, s6)
 topo.unlink(s3, s2)
-time.sleep(30)
+sim.core.sleep(30)
 h2a.ping(h1a)
 print("first ping sent")
-time.sleep(30)
+sim.core.sleep(30)
 h2a.ping(h1a)
 print("second ping sent")
-time.sleep(30)
+sim.core.sleep(30)
 h2a.ping(h1a)
 print("third ping sent")
-time.sleep(30)
+sim.core.sleep(30)
 print("TIMEOUT")
 os._exit(50)
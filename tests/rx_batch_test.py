@@ -0,0 +1,105 @@
+#!/bin/env python
+
+"""
+Checks Entity.handle_rx_batch(): an entity that overrides it gets all the
+packets that arrive at the same time in one call (with the ports they came
+in on, in the order they arrived), packets arriving at different times
+come in separate batches, and an entity that doesn't override it still
+gets every packet through handle_rx().
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.basics
+import sim.core
+import sim.topo as topo
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+class Numbered (api.Packet):
+  def __init__ (self, n):
+    api.Packet.__init__(self)
+    self.n = n
+
+
+class Source (api.Entity):
+  def burst (self, ns):
+    for n in ns:
+      self.send(Numbered(n), flood = True)
+
+
+class Batcher (api.Entity):
+  def __init__ (self):
+    self.batches = []
+
+  def handle_rx_batch (self, packets):
+    self.batches.append((sim.core.world.time(),
+                         [(p.n, port) for p, port in packets
+                          if isinstance(p, Numbered)]))
+
+
+class Single (api.Entity):
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    if isinstance(packet, Numbered):
+      self.got.append((sim.core.world.time(), packet.n, port))
+
+
+batcher = Batcher.create('batcher')
+single = Single.create('single')
+sources = [Source.create('s%i' % (i,)) for i in range(4)]
+for i, src in enumerate(sources):
+  # The sources are on the batcher's ports 0-3, in order
+  topo.link(src, batcher, latency = 1)
+  topo.link(src, single, latency = 1)
+
+world = sim.core.world
+sim.core.simulate(virtual = True, threaded = False)
+sim.core.run_until(5) # Let the discovery packets go by
+del batcher.batches[:]
+
+# All at 10 (and so arriving at 11), in the order s2, s0, s3
+world.doLater(5, sources[2].burst, [20, 21])
+world.doLater(5, sources[0].burst, [0])
+world.doLater(5, sources[3].burst, [30])
+# Alone at 12
+world.doLater(6, sources[1].burst, [10])
+# Together again at 13.5
+world.doLater(7.5, sources[1].burst, [11])
+world.doLater(7.5, sources[0].burst, [1, 2])
+sim.core.run_until(20)
+
+expected = [
+  (11.0, [(20, 2), (21, 2), (0, 0), (30, 3)]),
+  (12.0, [(10, 1)]),
+  (13.5, [(11, 1), (1, 0), (2, 0)]),
+]
+
+failed = []
+if batcher.batches != expected:
+  failed.append("The batches were %s" % (batcher.batches,))
+got = [(t, n) for t, n, port in single.got]
+want = [(t, n) for t, batch in expected for n, port in batch]
+if got != want:
+  failed.append("handle_rx() got %s" % (got,))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Batches were wrong!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
@@ -0,0 +1,128 @@
+#!/bin/env python
+
+"""
+Checks that spilling to disk (see sim/spill.py) keeps memory use down
+without changing anything.  A host sends a steady stream of packets down a
+cable that takes 100 seconds to deliver them, so there are thousands in
+flight at once.  With spilling, only those due in the next bucket or so
+may be in memory (in the World's heap or queued in the cable's Fifo, or
+as Packet objects at all), and everything must arrive just as it does
+without spilling.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import gc
+import logging
+
+import sim.api as api
+import sim.basics
+import sim.core
+import sim.topo as topo
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+RATE = 10 # Packets per tick
+TICK = 0.1
+LATENCY = 100
+UNTIL = 250
+
+
+class Numbered (api.Packet):
+  def __init__ (self, n):
+    api.Packet.__init__(self)
+    self.n = n
+    self.payload = [n] * 4
+
+
+class Source (api.Entity):
+  def __init__ (self):
+    self.sent = 0
+
+  def tick (self, timer):
+    for i in range(RATE):
+      self.sent += 1
+      self.send(Numbered(self.sent), 0)
+    if self.sent >= RATE * 1500:
+      timer.cancel()
+
+
+class Sink (api.Entity):
+  def __init__ (self):
+    self.got = []
+
+  def handle_rx (self, packet, port):
+    if isinstance(packet, Numbered):
+      self.got.append((sim.core.current().world.time(), packet.n,
+                       packet.payload, packet.trace[0].name))
+
+
+def packets ():
+  """ How many packets there are in memory """
+  return sum(1 for o in gc.get_objects() if isinstance(o, api.Packet))
+
+
+def run (spill):
+  s = sim.core.Simulation()
+  with s:
+    src = Source.create('src')
+    dst = Sink.create('dst')
+    topo.link(src, dst, latency = LATENCY)
+    api.create_timer(TICK, src.tick, pass_self = True)
+  world = s.world
+  if spill:
+    world.spill_to_disk(width = 1)
+  s.simulate(virtual = True, threaded = False)
+  most = {'events' : 0, 'packets' : 0, 'spilled' : 0}
+  t = 0
+  while t < UNTIL:
+    t += 5
+    s.run_until(t)
+    most['events'] = max(most['events'], len(world._heap) + world._in_fifos)
+    most['packets'] = max(most['packets'], packets())
+    if spill:
+      most['spilled'] = max(most['spilled'], world.spill.count)
+  if spill:
+    world.spill.close()
+  return dst.got, most
+
+
+failed = []
+
+got, most = run(spill = True)
+expected, without = run(spill = False)
+
+print("Most in memory without spilling: %(events)i events, %(packets)i "
+      "packets" % without)
+print("Most in memory with spilling: %(events)i events, %(packets)i "
+      "packets (and %(spilled)i events on disk)" % most)
+
+if without['events'] < RATE / TICK * LATENCY / 2:
+  failed.append("Not many packets were in flight")
+if most['spilled'] < RATE / TICK * LATENCY / 2:
+  failed.append("Not much was spilled")
+# Two buckets' worth (the one being worked on and the one loaded next)
+bound = 2 * RATE / TICK * 1 + 50
+if most['events'] > bound:
+  failed.append("%i events were in memory" % (most['events'],))
+if most['packets'] > bound:
+  failed.append("%i packets were in memory" % (most['packets'],))
+if len(expected) != RATE * 1500:
+  failed.append("%i packets arrived" % (len(expected),))
+if got != expected:
+  failed.append("Spilling changed what arrived")
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Spilling misbehaved!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
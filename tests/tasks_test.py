@@ -0,0 +1,122 @@
+#!/bin/env python
+
+"""
+Checks scripts (see sim/tasks.py), both with the simulator in a thread of
+its own and without: sleeping, waiting for a Pong (and timing out when
+none comes), waiting for lists of things and for other scripts, getting
+a TypeError for yielding something that can't be waited for, seeing the
+exception from a script that fails, and run_script() raising it.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import logging
+
+import sim.api as api
+import sim.basics as basics
+import sim.core
+import sim.tasks as tasks
+import sim.topo as topo
+from hub import Hub
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+
+def child ():
+  yield 1
+  yield tasks.sleep(0.5)
+
+def bad ():
+  yield 1
+  raise ValueError("boom")
+
+
+def run (threaded):
+  s = sim.core.Simulation()
+  with s:
+    h1 = basics.BasicHost.create('h1')
+    h2 = basics.BasicHost.create('h2')
+    h3 = basics.BasicHost.create('h3') # Not linked to anything
+    hub = Hub.create('hub')
+    topo.link(h1, hub)
+    topo.link(hub, h2)
+  world = s.world
+  log = []
+
+  def script ():
+    start = world.time()
+    def note (*what):
+      log.append((world.time() - start,) + what)
+    yield tasks.sleep(5)
+    note('slept')
+    pong = yield h1.ping_and_wait(h2, timeout = 10)
+    note('pong', type(pong).__name__, pong.original.src is h1)
+    pong = yield h1.ping_and_wait(h3, timeout = 10)
+    note('pong', pong)
+    values = yield [tasks.sleep(1), 2, [tasks.sleep(0.5)]]
+    note('list', values)
+    task = s.spawn(child())
+    yield task
+    note('child', task.done, task.error)
+    try:
+      yield "x"
+    except TypeError as e:
+      note('TypeError', str(e))
+    try:
+      yield s.spawn(bad())
+    except ValueError as e:
+      note('ValueError', str(e))
+    yield tasks.quiescent()
+    note('quiet')
+
+  s.simulate(virtual = True, threaded = threaded)
+  task = s.run_script(script())
+  ran = (task.done, task.error)
+  try:
+    s.run_script(bad())
+    raised = None
+  except ValueError as e:
+    raised = str(e)
+  return log, ran, raised
+
+
+# Seconds since the script started (each link takes a second to cross)
+expected = [
+  (5, 'slept'),
+  (9, 'pong', 'Pong', True),
+  (19, 'pong', None),
+  (21, 'list', [None, None, [None]]),
+  (22.5, 'child', True, None),
+  (22.5, 'TypeError', "Scripts can't wait for 'x'"),
+  (23.5, 'ValueError', "boom"),
+  (23.5, 'quiet'),
+]
+
+failed = []
+for threaded in (False, True):
+  how = "threaded" if threaded else "not threaded"
+  log, ran, raised = run(threaded)
+  if len(log) != len(expected):
+    failed.append("%s, the script did %s" % (how, log))
+  for got, want in zip(log, expected):
+    if abs(got[0] - want[0]) > 0.05 or got[1:] != want[1:]:
+      failed.append("%s, got %s, not %s" % (how, got, want))
+  if ran != (True, None):
+    failed.append("%s, run_script() returned a task that's %s" % (how, ran))
+  if raised != "boom":
+    failed.append("%s, run_script() raised %s" % (how, raised))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Scripts misbehaved!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)
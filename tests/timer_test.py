@@ -0,0 +1,103 @@
+#!/bin/env python
+
+"""
+Checks that timers fire when they should: timers cancelled by another
+timer due in the same tick, timers far enough out to cascade down through
+the levels of the timing wheel, and a lot of random ones cancelling each
+other.
+"""
+
+import sys
+sys.path.append('.')
+
+_DISABLE_INTERFACE = True
+
+import os
+import random
+import logging
+
+import sim.api as api
+import sim.core
+
+api.simlog.setLevel(logging.DEBUG)
+
+_DISABLE_CONSOLE_LOG = True
+
+failed = []
+fired = {}
+
+def check (name, due, cancelled = False):
+  t = fired.get(name)
+  if cancelled:
+    if t is not None:
+      failed.append("%s was cancelled but fired at %s" % (name, t))
+  elif t is None:
+    failed.append("%s never fired (due at %s)" % (name, due))
+  elif abs(t - due) > 0.011:
+    failed.append("%s fired at %s (due at %s)" % (name, t, due))
+
+def timer (name, seconds, func = None):
+  def fire ():
+    fired[name] = sim.core.world.time()
+    if func: func()
+  return api.create_timer(seconds, fire, recurring = False)
+
+# A timer cancelling the next one due in the same tick
+timers = {}
+timer('a', 1.0, lambda: timers['b'].cancel())
+timers['b'] = timer('b', 1.0)
+timer('c', 2.0)
+
+# Timers on the coarser levels of the wheel (and past the end of it)
+for seconds in (0.5, 3, 30, 700, 1000, 200000):
+  timer('far%s' % (seconds,), seconds)
+
+# A recurring timer
+ticks = []
+api.create_timer(7, lambda: ticks.append(sim.core.world.time()))
+
+# Lots of timers cancelling random others, some due in the same tick
+r = random.Random(4)
+randoms = {}
+dues = {}
+cancelled = set()
+def canceller (victim):
+  def f ():
+    if victim not in fired:
+      cancelled.add(victim)
+      randoms[victim].cancel()
+  return f
+for i in range(2000):
+  due = round(r.uniform(0, 900), 2)
+  name = 'r%i' % (i,)
+  dues[name] = due
+  victim = 'r%i' % (r.randrange(2000),)
+  func = canceller(victim) if r.random() < .3 and victim != name else None
+  randoms[name] = timer(name, due, func)
+
+# If the world thread dies, sleep() returns and whatever was left shows up
+# as never having fired
+sim.core.simulate(virtual=True)
+sim.core.sleep(100)
+sim.core.sleep(250000)
+
+check('a', 1.0)
+check('b', 1.0, cancelled = True)
+check('c', 2.0)
+for seconds in (0.5, 3, 30, 700, 1000, 200000):
+  check('far%s' % (seconds,), seconds)
+for name, due in dues.iteritems():
+  if name in fired or name not in cancelled:
+    check(name, due)
+for i, t in enumerate(ticks[:10]):
+  if abs(t - 7 * (i + 1)) > 0.011 * (i + 1):
+    failed.append("The recurring timer fired at %s" % (t,))
+
+if failed:
+  for f in failed[:20]:
+    print(f)
+  print("Timers misbehaved!")
+  os._exit(0)
+else:
+  print("Test is successful!")
+  os._exit(2)